@@ -6,9 +6,15 @@ Apache License
 Implements VGG-style discriminator for 3D data
 """
 
+import torch
 import torch.nn as nn
 
-from CNN_models.torch_blocks import create_discriminator_block, create_conv_lrelu_layer
+from CNN_models.torch_blocks import (
+    create_discriminator_block,
+    create_conv_lrelu_layer,
+    Horizontal_Conv_3D,
+    SplitBatchNorm3d,
+)
 import tools.loggingclass as lc
 
 
@@ -50,7 +56,6 @@ class Discriminator_3D(nn.Module, lc.GlobalLoggingClass):
             slope = 0.2
 
         features = []
-        # self.scaler = torch.cuda.amp.GradScaler(enabled=use_mixed_precision)
 
         remainder_z_layers = [number_of_z_layers]
         for i in range(5):
@@ -182,12 +187,31 @@ class Discriminator_3D(nn.Module, lc.GlobalLoggingClass):
         )
 
         self.features = nn.Sequential(*features)
+        # Pools the features to the 4x4 horizontal size the classifier expects, so D
+        # accepts other input sizes than the one it is built for. Identity at that size.
+        self.pool = nn.AdaptiveAvgPool3d((4, 4, None))
         self.classifier = nn.Sequential(*classifier)
+        self.memory_format = torch.contiguous_format
 
         self.status_logs.append(f"Discriminator: finished init")
 
+    def set_memory_format(self, memory_format: torch.memory_format):
+        """Converts the weights, and the inputs of every forward, to memory_format"""
+        self.memory_format = memory_format
+        return self.to(memory_format=memory_format)
+
+    def split_batch_norm(self, number_of_splits: int):
+        """
+        Makes the batch norms of D normalize each of number_of_splits equal parts of the batch
+        with its own statistics, e.g. 2 for real and fake fields in one forward. 1 to reset.
+        """
+        for module in self.modules():
+            if isinstance(module, (SplitBatchNorm3d, Horizontal_Conv_3D)):
+                module.batch_norm_splits = number_of_splits
+
     def forward(self, x):
-        x = self.dropout(self.features(x))
+        x = x.contiguous(memory_format=self.memory_format)
+        x = self.dropout(self.pool(self.features(x)))
         # flatten
         x = x.reshape(x.shape[0], -1)
         return self.classifier(x)
@@ -7,15 +7,21 @@ Implements the ESRDnet nn.Module modified to 3D, and with dropout and terrain fe
 """
 
 import math
+import time
+from collections import OrderedDict
 import torch.nn as nn
 import torch
 from CNN_models.torch_blocks import (
     RRDB,
+    CheckpointedSequential,
     create_UpConv_block,
     SkipConnectionBlock,
     create_conv_lrelu_layer,
     Horizontal_Conv_3D,
     create_UpConv_block,
+    scripted_RDB_convs,
+    conv_layer_type,
+    FACTORIZED_CONV_MODES,
 )
 import tools.loggingclass as lc
 
@@ -43,8 +49,15 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
         terrain_number_of_features: int = 16,
         dropout_probability: float = 0.0,
         max_norm: float = 1.0,
+        checkpoint_RRDBs: int = 0,
+        script_RDB_convs: bool = True,
+        upsampler_type: str = "nearest",
+        dense_block_mode: str = "concat",
+        cache_scripted_RDB_convs: bool = True,
     ):
         super(Generator_3D, self).__init__()
+        start = time.perf_counter()
+        number_of_scripted_signatures = len(scripted_RDB_convs)
 
         slope = 0
         if act_type == "leakyrelu":
@@ -58,11 +71,11 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
             slope = 0.2
 
         self.max_norm = max_norm
+        self.number_of_features = number_of_features
 
-        layer_type = nn.Conv2d if conv_mode == "2D" else nn.Conv3d
+        layer_type = conv_layer_type(conv_mode)
 
         hr_pad = (hr_kern_size - 1) // 2
-        # self.scaler = torch.cuda.amp.GradScaler(enabled=use_mixed_precision)
 
         if dropout_probability == None:
             dropout_probability = 0.0
@@ -74,7 +87,8 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
         )
 
         # Low level feature extraction
-        if conv_mode in {"3D", "2D"}:
+        # factorized modes replace every 3D conv by an xy and a z conv
+        if conv_mode in {"3D", "2D"} or conv_mode in FACTORIZED_CONV_MODES:
             feature_conv = create_conv_lrelu_layer(
                 in_channels,
                 number_of_features,
@@ -176,6 +190,7 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
                 number_of_z_layers=number_of_z_layers,
                 lrelu=False,
             )
+            terrain_convs = [terrain_conv]
 
         else:
             raise ValueError(f"Conv mode {conv_mode} not implemented")
@@ -190,14 +205,20 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
                 RDB_residual_scaling=RDB_residual_scaling,
                 RRDB_residual_scaling=RRDB_residual_scaling,
                 mode=conv_mode,
+                script_convs=script_RDB_convs,
+                dense_block_mode=dense_block_mode,
+                cache_scripted_convs=cache_scripted_RDB_convs,
             )
             for i in range(number_of_RRDBs)
         ]
 
         # Shortcut from feature_conv to the upsampler
-        RRDB_conv_shortcut = SkipConnectionBlock(nn.Sequential(*RRDBs, lr_conv))
+        # checkpoint_RRDBs > 0 recomputes the activations of every checkpoint_RRDBs RRDBs in backward
+        RRDB_conv_shortcut = SkipConnectionBlock(
+            CheckpointedSequential(*RRDBs, lr_conv, segment_size=checkpoint_RRDBs)
+        )
 
-        # Upsampling: Upsample+conv combo
+        # Upsampling: Upsample+conv combo, or conv+pixel shuffle with upsampler_type pixel_shuffle
         number_of_upsample_layers = math.floor(math.log2(upscale))
 
         if 2**number_of_upsample_layers != upscale:
@@ -213,6 +234,7 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
                 lrelu_negative_slope=slope,
                 number_of_z_layers=number_of_z_layers,
                 mode=conv_mode,
+                upsampler_type=upsampler_type,
             )
             for upsample in range(number_of_upsample_layers)
         ]
@@ -220,10 +242,136 @@ class Generator_3D(nn.Module, lc.GlobalLoggingClass):
         self.model = nn.Sequential(feature_conv, RRDB_conv_shortcut, *upsampler)
         self.hr_convs = nn.Sequential(*hr_convs_w_dropout)
         self.terrain_convs = nn.Sequential(*terrain_convs)
-        self.status_logs.append(f"Generator: finished init")
+        self.use_terrain_cache = False
+        self.terrain_cache_tolerance = 0.0
+        self.terrain_cache_size = 16
+        self.terrain_cache = OrderedDict()
+        self.memory_format = torch.contiguous_format
+        construction_log = (
+            f"Generator: finished init in {time.perf_counter() - start:.2f} s"
+        )
+        if script_RDB_convs and cache_scripted_RDB_convs:
+            construction_log += f", scripted {len(scripted_RDB_convs) - number_of_scripted_signatures} new RDB conv signatures"
+        self.status_logs.append(construction_log)
 
     def forward(self, x, Z):
+        x = x.contiguous(memory_format=self.memory_format)
+        Z = Z.contiguous(memory_format=self.memory_format)
         x = self.model(x)
-        Z = self.terrain_convs(Z)
+        Z = self.terrain_features(Z)
         x = torch.cat((x, Z), dim=1)
         return self.hr_convs(x)
+
+    def forward_with_trunk(self, x, Z):
+        """
+        forward, also returning the trunk features: the LR features after the RRDBs and
+        their shortcut, before upsampling
+        """
+        x = x.contiguous(memory_format=self.memory_format)
+        Z = Z.contiguous(memory_format=self.memory_format)
+        trunk = self.model[:2](x)
+        x = self.model[2:](trunk)
+        x = torch.cat((x, self.terrain_features(Z)), dim=1)
+        return self.hr_convs(x), trunk
+
+    def forward_mc_dropout(
+        self, x, Z, number_of_samples: int, samples_per_batch: int = 0
+    ):
+        """
+        Monte Carlo dropout: mean and standard deviation of number_of_samples forwards with
+        the dropout of the hr convs active. Everything before the dropout, the trunk, upsampler,
+        terrain features and first hr conv, runs once. Only its output is replicated in the
+        batch dimension, samples_per_batch samples at a time (0 for all at once).
+        """
+        x = x.contiguous(memory_format=self.memory_format)
+        Z = Z.contiguous(memory_format=self.memory_format)
+        x = torch.cat((self.model(x), self.terrain_features(Z)), dim=1)
+        features = self.hr_convs[0](x)
+        dropout, hr_conv = self.hr_convs[1], self.hr_convs[2]
+        dropout_function = (
+            nn.functional.dropout2d
+            if isinstance(dropout, nn.Dropout2d)
+            else nn.functional.dropout3d
+        )
+        if samples_per_batch <= 0:
+            samples_per_batch = number_of_samples
+
+        # mean and sum of squared deviations, merged over the chunks of samples (Chan et al.)
+        count, mean, M2 = 0, None, None
+        for first in range(0, number_of_samples, samples_per_batch):
+            chunk_size = min(samples_per_batch, number_of_samples - first)
+            samples = hr_conv(
+                dropout_function(
+                    features.repeat_interleave(chunk_size, dim=0),
+                    dropout.p,
+                    training=True,
+                )
+            )
+            # the statistics of autocast samples are computed in float32
+            samples = samples.unflatten(0, (features.shape[0], chunk_size)).to(
+                torch.promote_types(samples.dtype, torch.float32)
+            )
+            chunk_mean = samples.mean(dim=1)
+            chunk_M2 = (samples - chunk_mean.unsqueeze(1)).square().sum(dim=1)
+            if mean is None:
+                count, mean, M2 = chunk_size, chunk_mean, chunk_M2
+                continue
+            delta = chunk_mean - mean
+            total = count + chunk_size
+            mean = mean + delta * (chunk_size / total)
+            M2 = M2 + chunk_M2 + delta.square() * (count * chunk_size / total)
+            count = total
+        std = (M2 / max(count - 1, 1)).sqrt()
+        return mean, std
+
+    def set_memory_format(self, memory_format: torch.memory_format):
+        """Converts the weights, and the inputs of every forward, to memory_format"""
+        self.memory_format = memory_format
+        self.clear_terrain_cache()
+        return self.to(memory_format=memory_format)
+
+    def enable_terrain_cache(self, tolerance: float = 0.0, size: int = 16):
+        """
+        In eval mode, reuse the terrain features of the last size distinct Z, e.g. the tiles
+        of one domain, if no value of Z differs from a cached one by more than tolerance
+        (normalized units). A non-zero tolerance is only safe for a single fixed domain:
+        different terrain within the tolerance, e.g. flat tiles, shares features.
+        """
+        self.use_terrain_cache = True
+        self.terrain_cache_tolerance = tolerance
+        self.terrain_cache_size = max(size, 1)
+        self.terrain_cache = OrderedDict()
+
+    def clear_terrain_cache(self):
+        self.terrain_cache = OrderedDict()
+
+    def terrain_fingerprint(self, Z):
+        """
+        Exact sums of Z for tolerance 0, otherwise its mean in steps of the tolerance, which
+        a Z within the tolerance shares unless it crosses a step, a cache miss
+        """
+        if self.terrain_cache_tolerance <= 0:
+            return tuple(torch.stack((Z.sum(), Z.abs().sum())).tolist())
+        return round(Z.mean().item() / self.terrain_cache_tolerance)
+
+    def train(self, mode: bool = True):
+        self.clear_terrain_cache()
+        return super(Generator_3D, self).train(mode)
+
+    def terrain_features(self, Z):
+        if not self.use_terrain_cache or self.training:
+            return self.terrain_convs(Z)
+
+        key = (tuple(Z.shape), Z.dtype, Z.device, self.terrain_fingerprint(Z))
+        if key in self.terrain_cache:
+            cached_Z, cached_features = self.terrain_cache[key]
+            if (Z - cached_Z).abs().max().item() <= self.terrain_cache_tolerance:
+                self.terrain_cache.move_to_end(key)
+                return cached_features
+
+        features = self.terrain_convs(Z).detach()
+        self.terrain_cache[key] = (Z.detach().clone(), features)
+        self.terrain_cache.move_to_end(key)
+        if len(self.terrain_cache) > self.terrain_cache_size:
+            self.terrain_cache.popitem(last=False)
+        return features
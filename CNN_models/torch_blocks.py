@@ -1,5 +1,10 @@
+import copy
+import functools
+from typing import List
+
 from torch import nn
 import torch
+import torch.utils.checkpoint
 
 
 def create_conv_lrelu_layer(
@@ -21,12 +26,12 @@ def create_conv_lrelu_layer(
         if normalization_type == "batch":
             if layer_type == nn.Conv2d:
                 layers.append(nn.BatchNorm2d(out_channels))
-            elif layer_type == nn.Conv3d:
-                layers.append(nn.BatchNorm3d(out_channels))
+            else:
+                layers.append(SplitBatchNorm3d(out_channels))
         elif normalization_type == "instance":
             if layer_type == nn.Conv2d:
                 layers.append(nn.InstanceNorm2d(out_channels))
-            elif layer_type == nn.Conv3d:
+            else:
                 layers.append(nn.InstanceNorm3d(out_channels))
         else:
             raise NotImplementedError(f"Unknown norm type {normalization_type}")
@@ -37,6 +42,117 @@ def create_conv_lrelu_layer(
     return nn.Sequential(*layers)
 
 
+class SplitBatchNorm3d(nn.BatchNorm3d):
+    """
+    nn.BatchNorm3d that normalizes each of batch_norm_splits equal parts of the batch with its
+    own statistics, and updates the running statistics part by part, like separate forwards
+    of the parts. With batch_norm_splits = 1, the default, it is nn.BatchNorm3d.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SplitBatchNorm3d, self).__init__(*args, **kwargs)
+        self.batch_norm_splits = 1
+
+    def forward(self, x):
+        if self.batch_norm_splits == 1:
+            return super(SplitBatchNorm3d, self).forward(x)
+        return torch.cat(
+            [
+                super(SplitBatchNorm3d, self).forward(part)
+                for part in x.chunk(self.batch_norm_splits)
+            ]
+        )
+
+
+class Factorized_Conv_3D(nn.Module):
+    """
+    Called like nn.Conv3d, but factorized into a horizontal (k, k, 1) conv and a vertical
+    (1, 1, k) conv. With depthwise, both are depthwise convs on the input channels, followed
+    by a pointwise conv to out_channels, i.e. a depthwise separable conv.
+    """
+
+    def __init__(
+        self,
+        in_channels: int,
+        out_channels: int,
+        kernel_size=3,
+        stride=1,
+        padding=0,
+        bias: bool = True,
+        depthwise: bool = False,
+    ):
+        super(Factorized_Conv_3D, self).__init__()
+        kernel_size, stride, padding = (
+            value if isinstance(value, tuple) else (value, value, value)
+            for value in (kernel_size, stride, padding)
+        )
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        xy_channels = in_channels if depthwise else out_channels
+        self.xy_conv = nn.Conv3d(
+            in_channels,
+            xy_channels,
+            (kernel_size[0], kernel_size[1], 1),
+            (stride[0], stride[1], 1),
+            (padding[0], padding[1], 0),
+            groups=in_channels if depthwise else 1,
+            bias=False,
+        )
+        self.z_conv = nn.Conv3d(
+            xy_channels,
+            xy_channels,
+            (1, 1, kernel_size[2]),
+            (1, 1, stride[2]),
+            (0, 0, padding[2]),
+            groups=xy_channels if depthwise else 1,
+            bias=bias and not depthwise,
+        )
+        self.pointwise_conv = (
+            nn.Conv3d(in_channels, out_channels, 1, bias=bias)
+            if depthwise
+            else nn.Identity()
+        )
+
+    def forward(self, x):
+        return self.pointwise_conv(self.z_conv(self.xy_conv(x)))
+
+
+# conv modes of Factorized_Conv_3D, and if they are depthwise separable
+FACTORIZED_CONV_MODES = {"factorized_3D": False, "factorized_depthwise_3D": True}
+
+
+def conv_layer_type(mode: str):
+    """The layer_type of create_conv_lrelu_layer for the 2D, 3D and factorized conv modes"""
+    if mode == "2D":
+        return nn.Conv2d
+    if mode in FACTORIZED_CONV_MODES:
+        return functools.partial(
+            Factorized_Conv_3D, depthwise=FACTORIZED_CONV_MODES[mode]
+        )
+    return nn.Conv3d
+
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    nn.Sequential that, while training, recomputes the activations of every
+    segment_size consecutive modules in the backward pass instead of storing them.
+    Has the same state dict keys as nn.Sequential.
+    """
+
+    def __init__(self, *modules, segment_size: int = 1):
+        super(CheckpointedSequential, self).__init__(*modules)
+        self.segment_size = segment_size
+
+    def forward(self, x):
+        if self.segment_size <= 0 or not self.training or not torch.is_grad_enabled():
+            return super(CheckpointedSequential, self).forward(x)
+        modules = list(self)
+        for start in range(0, len(modules), self.segment_size):
+            segment = nn.Sequential(*modules[start : start + self.segment_size])
+            x = torch.utils.checkpoint.checkpoint(segment, x, use_reentrant=False)
+        return x
+
+
 class SkipConnectionBlock(nn.Module):
     def __init__(self, submodule):
         super(SkipConnectionBlock, self).__init__()
@@ -90,6 +206,60 @@ def forward_horizontal_convs(
     return y
 
 
+def forward_batched_horizontal_convs(
+    x,
+    weight,
+    number_of_levels: int,
+    stride: List[int],
+    padding: List[int],
+    vertical_kernel_size: int = 3,
+    vertical_stride: int = 1,
+    vertical_padding: int = 1,
+):
+    """
+    Loop-free forward_horizontal_convs without normalization and activation.
+    The z windows of all levels are folded into the channels, and a single grouped
+    conv with the per-level weights stacked along the output channels is run.
+    The windows are concatenated rather than unfolded, as ONNX can not export unfold
+    of inputs with dynamic sizes.
+    Returns (batch, number_of_levels * out_channels, x, y, 1), see levels_to_z.
+    """
+    x = torch.nn.functional.pad(x, (vertical_padding, vertical_padding))
+    windows = torch.cat(
+        [
+            x[
+                :,
+                :,
+                :,
+                :,
+                level * vertical_stride : level * vertical_stride
+                + vertical_kernel_size,
+            ]
+            for level in range(number_of_levels)
+        ],
+        1,
+    )
+    return torch.nn.functional.conv3d(
+        windows,
+        weight,
+        None,
+        (stride[0], stride[1], 1),
+        (padding[0], padding[1], 0),
+        1,
+        number_of_levels,
+    )
+
+
+def levels_to_z(x, number_of_levels: int):
+    return x.view(
+        x.shape[0],
+        number_of_levels,
+        x.shape[1] // number_of_levels,
+        x.shape[2],
+        x.shape[3],
+    ).permute(0, 2, 3, 4, 1)
+
+
 class Horizontal_Conv_3D(nn.Module):
     def __init__(
         self,
@@ -120,6 +290,11 @@ class Horizontal_Conv_3D(nn.Module):
         )
 
         super(Horizontal_Conv_3D, self).__init__()
+        self.lrelu_negative_slope = lrelu_negative_slope
+        # see SplitBatchNorm3d
+        self.batch_norm_splits = 1
+        self.lrelu = lrelu
+        self.normalization_type = normalization_type
         self.convs = nn.ModuleList(
             [
                 create_conv_lrelu_layer(
@@ -146,14 +321,77 @@ class Horizontal_Conv_3D(nn.Module):
         )
 
     def forward(self, x):
-        return forward_horizontal_convs(
+        number_of_levels = len(self.convs)
+        conv = self.convs[0][0]
+        out = forward_batched_horizontal_convs(
             x,
-            self.convs,
+            torch.cat([level[0].weight for level in self.convs]),
+            number_of_levels,
+            conv.stride,
+            conv.padding,
             vertical_kernel_size=self.vertical_kernel_size,
-            vertical_padding=self.vertical_padding,
             vertical_stride=self.vertical_stride,
+            vertical_padding=self.vertical_padding,
         )
 
+        if self.normalization_type == "instance":
+            norm = self.convs[0][1]
+            out = nn.functional.instance_norm(out, eps=norm.eps)
+        elif self.normalization_type == "batch":
+            if self.batch_norm_splits == 1:
+                out = self.forward_stacked_batch_norm(out)
+            else:
+                out = torch.cat(
+                    [
+                        self.forward_stacked_batch_norm(part)
+                        for part in out.chunk(self.batch_norm_splits)
+                    ]
+                )
+
+        if self.lrelu:
+            out = nn.functional.leaky_relu(out, self.lrelu_negative_slope)
+        return levels_to_z(out, number_of_levels)
+
+    def forward_stacked_batch_norm(self, x):
+        """
+        Applies the BatchNorm3d of every level at once, on stacked parameters and
+        running statistics. Updated statistics are copied back to the levels.
+        """
+        norms = [level[1] for level in self.convs]
+        use_batch_stats = self.training or norms[0].running_mean is None
+        running_mean, running_var = None, None
+        if norms[0].track_running_stats and norms[0].running_mean is not None:
+            running_mean = torch.cat([norm.running_mean for norm in norms])
+            running_var = torch.cat([norm.running_var for norm in norms])
+        momentum = norms[0].momentum
+        if self.training and norms[0].track_running_stats:
+            for norm in norms:
+                norm.num_batches_tracked.add_(1)
+            if momentum is None:
+                momentum = 1.0 / float(norms[0].num_batches_tracked)
+
+        out = nn.functional.batch_norm(
+            x,
+            running_mean,
+            running_var,
+            torch.cat([norm.weight for norm in norms]) if norms[0].affine else None,
+            torch.cat([norm.bias for norm in norms]) if norms[0].affine else None,
+            use_batch_stats,
+            0.0 if momentum is None else momentum,
+            norms[0].eps,
+        )
+
+        if self.training and running_mean is not None:
+            with torch.no_grad():
+                for norm, mean, var in zip(
+                    norms,
+                    running_mean.chunk(len(norms)),
+                    running_var.chunk(len(norms)),
+                ):
+                    norm.running_mean.copy_(mean)
+                    norm.running_var.copy_(var)
+        return out
+
 
 class RDB_Horizontal_Conv_3D(nn.Module):
     def __init__(
@@ -180,13 +418,31 @@ class RDB_Horizontal_Conv_3D(nn.Module):
             ]
         )
         self.out_channels = out_channels
+        self.vertical_kernel_size = kernel_size
         self.vertical_padding = (kernel_size - 1) // 2
+        self.lrelu_negative_slope = lrelu_negative_slope
+
+    @torch.jit.export
+    def growth(self, x):
+        """The growth_channels new features, without the input"""
+        weights: List[torch.Tensor] = []
+        for level in self.convs:
+            weights.append(level[0].weight)
+        out = forward_batched_horizontal_convs(
+            x,
+            torch.cat(weights),
+            len(weights),
+            [1, 1],
+            [self.vertical_padding, self.vertical_padding],
+            vertical_kernel_size=self.vertical_kernel_size,
+            vertical_padding=self.vertical_padding,
+        )
+        return levels_to_z(
+            nn.functional.leaky_relu(out, self.lrelu_negative_slope), len(weights)
+        )
 
     def forward(self, x):
-        out = forward_horizontal_convs(
-            x, self.convs, vertical_padding=self.vertical_padding
-        )
-        return torch.cat((x, out), 1)
+        return torch.cat((x, self.growth(x)), 1)
 
 
 class RDB_Conv(nn.Module):
@@ -209,9 +465,54 @@ class RDB_Conv(nn.Module):
             layer_type=layer_type,
         )
 
+    @torch.jit.export
+    def growth(self, x):
+        """The growth_channels new features, without the input"""
+        return self.conv(x)
+
     def forward(self, x):
-        out = self.conv(x)
-        return torch.cat((x, out), 1)
+        return torch.cat((x, self.growth(x)), 1)
+
+
+# scripted RDB convs by signature, see script_RDB_conv
+scripted_RDB_convs = {}
+
+
+def script_RDB_conv(conv: nn.Module, signature: tuple, use_cache: bool = True):
+    """
+    torch.jit.script(conv), or with use_cache a copy of the conv scripted first for signature,
+    with the parameters of conv. signature must determine the compiled graph, i.e. the
+    structure and constants of conv. Copying skips the compilation, which takes most of the
+    construction time of generators with scripted RDB convs.
+    """
+    if not use_cache:
+        return torch.jit.script(conv)
+    if signature not in scripted_RDB_convs:
+        scripted_RDB_convs[signature] = torch.jit.script(conv)
+    # copied with gradients, the parameters of the copy would be non-leaf clones of the template's
+    with torch.no_grad():
+        scripted = copy.deepcopy(scripted_RDB_convs[signature])
+    scripted.load_state_dict(conv.state_dict())
+    for scripted_parameter, parameter in zip(scripted.parameters(), conv.parameters()):
+        scripted_parameter.requires_grad_(parameter.requires_grad)
+    return scripted
+
+
+class SharedStorageConcat(torch.autograd.Function):
+    """
+    Autograd view of features, a buffer the pieces have already been written into, as the
+    concatenation of the pieces along the channels. Forward copies nothing, backward splits
+    the gradient between the pieces.
+    """
+
+    @staticmethod
+    def forward(ctx, features, *pieces):
+        ctx.channels = [piece.shape[1] for piece in pieces]
+        return features
+
+    @staticmethod
+    def backward(ctx, grad):
+        return (None,) + tuple(grad.split(ctx.channels, 1))
 
 
 class RDB(nn.Module):
@@ -229,10 +530,29 @@ class RDB(nn.Module):
         lrelu_negative_slope: float = 0.2,
         residual_scaling=0.2,
         mode="2D",
+        script_convs: bool = True,
+        dense_block_mode: str = "concat",
+        cache_scripted_convs: bool = True,
     ):
         super(RDB, self).__init__()
         self.residual_scaling = residual_scaling
+        if dense_block_mode not in {"concat", "shared_buffer"}:
+            raise NotImplementedError(f"Unknown dense block mode {dense_block_mode}")
+        self.dense_block_mode = dense_block_mode
+
+        # scripted convs are faster in training, unscripted ones can be traced (e.g. by FX)
+        def script(conv: nn.Module, signature: tuple) -> nn.Module:
+            if not script_convs:
+                return conv
+            return script_RDB_conv(conv, signature, use_cache=cache_scripted_convs)
+
         for i in range(number_of_conv_layers - 1):
+            signature = (
+                mode,
+                in_channels + i * growth_channels,
+                growth_channels,
+                lrelu_negative_slope,
+            )
             if mode == "2D":
                 self.add_module(
                     "conv{}".format(i),
@@ -245,24 +565,26 @@ class RDB(nn.Module):
             elif mode == "horizontal_3D":
                 self.add_module(
                     "conv{}".format(i),
-                    torch.jit.script(
+                    script(
                         RDB_Horizontal_Conv_3D(
                             in_channels + i * growth_channels,
                             growth_channels,
                             lrelu_negative_slope=lrelu_negative_slope,
-                        )
+                        ),
+                        signature,
                     ),
                 )
-            elif mode == "3D":
+            elif mode == "3D" or mode in FACTORIZED_CONV_MODES:
                 self.add_module(
                     "conv{}".format(i),
-                    torch.jit.script(
+                    script(
                         RDB_Conv(
                             in_channels + i * growth_channels,
                             growth_channels,
                             lrelu_negative_slope=lrelu_negative_slope,
-                            layer_type=nn.Conv3d,
-                        )
+                            layer_type=conv_layer_type(mode),
+                        ),
+                        signature,
                     ),
                 )
             else:
@@ -275,7 +597,9 @@ class RDB(nn.Module):
 
         lff_pad = (lff_kern_size - 1) // 2  # no dim change
 
-        self.LFF = nn.Conv3d(
+        self.LFF = (
+            conv_layer_type(mode) if mode in FACTORIZED_CONV_MODES else nn.Conv3d
+        )(
             in_channels + (number_of_conv_layers - 1) * growth_channels,
             in_channels,
             kernel_size=lff_kern_size,
@@ -283,12 +607,54 @@ class RDB(nn.Module):
         )
 
     def forward(self, x):
+        if self.dense_block_mode == "shared_buffer":
+            return self.forward_shared_buffer(x)
         next_x = x.clone()
         for i in range(len(self._modules) - 1):
             next_x = self.__getattr__("conv{}".format(i))(next_x)
         residual = self.LFF(next_x)
         return residual.mul(self.residual_scaling) + x
 
+    def forward_shared_buffer(self, x):
+        """
+        Same as forward, but every conv writes its growth channels into one preallocated
+        feature buffer and reads a prefix of it, instead of concatenating its input and output.
+        With gradients, the convs save views of the buffer for backward instead of one
+        concatenation each.
+        """
+        memory_format = (
+            torch.channels_last_3d
+            if x.dim() == 5
+            and not x.is_contiguous()
+            and x.is_contiguous(memory_format=torch.channels_last_3d)
+            else torch.contiguous_format
+        )
+        features = torch.empty(
+            (x.shape[0], self.LFF.in_channels) + tuple(x.shape[2:]),
+            dtype=x.dtype,
+            device=x.device,
+            memory_format=memory_format,
+        )
+        # writes go through .data, so they do not bump the version of the views saved for backward
+        features.data[:, : x.shape[1]].copy_(x)
+        track_gradients = torch.is_grad_enabled()
+        pieces = [x]
+        end = x.shape[1]
+        for i in range(len(self._modules) - 1):
+            prefix = (
+                SharedStorageConcat.apply(features.data[:, :end], *pieces)
+                if track_gradients
+                else features[:, :end]
+            )
+            growth = self.__getattr__("conv{}".format(i)).growth(prefix)
+            features.data[:, end : end + growth.shape[1]].copy_(growth)
+            pieces.append(growth)
+            end += growth.shape[1]
+        if track_gradients:
+            features = SharedStorageConcat.apply(features.data, *pieces)
+        residual = self.LFF(features)
+        return residual.mul(self.residual_scaling) + x
+
 
 class RRDB(nn.Module):
     """
@@ -307,6 +673,9 @@ class RRDB(nn.Module):
         RRDB_residual_scaling: float = 0.2,
         number_of_RDBs: int = 3,
         mode="2D",
+        script_convs: bool = True,
+        dense_block_mode: str = "concat",
+        cache_scripted_convs: bool = True,
     ):
         super(RRDB, self).__init__()
         self.RRDB_residual_scaling = RRDB_residual_scaling
@@ -320,6 +689,9 @@ class RRDB(nn.Module):
                 residual_scaling=RDB_residual_scaling,
                 lff_kern_size=lff_kern_size,
                 mode=mode,
+                script_convs=script_convs,
+                dense_block_mode=dense_block_mode,
+                cache_scripted_convs=cache_scripted_convs,
             )
             for i in range(number_of_RDBs)
         ]
@@ -330,6 +702,26 @@ class RRDB(nn.Module):
         return residual.mul(self.RRDB_residual_scaling) + x
 
 
+class PixelShuffle_xy(nn.Module):
+    """
+    nn.PixelShuffle for x and y of 3D fields, rearranges
+    (batch, channels * upscale_factor**2, x, y, z) to (batch, channels, upscale_factor * x, upscale_factor * y, z)
+    """
+
+    def __init__(self, upscale_factor: int):
+        super(PixelShuffle_xy, self).__init__()
+        self.upscale_factor = upscale_factor
+
+    def forward(self, x):
+        r = self.upscale_factor
+        batch, channels, nx, ny, nz = x.shape
+        return (
+            x.reshape(batch, channels // (r * r), r, r, nx, ny, nz)
+            .permute(0, 1, 4, 2, 5, 3, 6)
+            .reshape(batch, channels // (r * r), nx * r, ny * r, nz)
+        )
+
+
 def create_UpConv_block(
     in_channels: int,
     out_channels: int,
@@ -337,12 +729,45 @@ def create_UpConv_block(
     lrelu_negative_slope: float = 0.2,
     mode="2D",
     number_of_z_layers=10,
+    upsampler_type: str = "nearest",
 ):
-    layer_type, scale_factor = (
-        (nn.Conv2d, scale) if mode == "2D" else (nn.Conv3d, (scale, scale, 1))
-    )
+    """
+    Upsamples x and y by scale. nearest: nearest neighbour upsampling followed by a conv at the
+    high resolution. pixel_shuffle: a conv to scale**2 times the channels at the low resolution,
+    followed by a sub-pixel rearrangement of the channels into x and y.
+    """
+    layer_type = conv_layer_type(mode)
+    scale_factor = scale if mode == "2D" else (scale, scale, 1)
+
+    if upsampler_type == "pixel_shuffle":
+        if mode in {"2D", "3D"} or mode in FACTORIZED_CONV_MODES:
+            conv = create_conv_lrelu_layer(
+                in_channels,
+                out_channels * scale**2,
+                kernel_size=3,
+                padding=1,
+                layer_type=layer_type,
+                lrelu=False,
+            )
+        elif mode == "horizontal_3D":
+            conv = Horizontal_Conv_3D(
+                in_channels,
+                out_channels * scale**2,
+                kernel_size=3,
+                number_of_z_layers=number_of_z_layers,
+                lrelu=False,
+            )
+        else:
+            raise NotImplementedError(f"Unknown UpConv mode {mode}")
+        return nn.Sequential(
+            conv,
+            nn.PixelShuffle(scale) if mode == "2D" else PixelShuffle_xy(scale),
+            nn.LeakyReLU(negative_slope=lrelu_negative_slope),
+        )
+    elif upsampler_type != "nearest":
+        raise NotImplementedError(f"Unknown upsampler type {upsampler_type}")
 
-    if mode in {"2D", "3D"}:
+    if mode in {"2D", "3D"} or mode in FACTORIZED_CONV_MODES:
         return nn.Sequential(
             nn.Upsample(scale_factor=scale_factor, mode="nearest"),
             create_conv_lrelu_layer(
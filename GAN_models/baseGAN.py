@@ -34,6 +34,7 @@ class BaseGAN(lc.GlobalLoggingClass):
         self.is_train = cfg.is_train
         self.schedulers = []
         self.optimizers = []
+        self.scalers = []
         return
 
     def load_model(
@@ -54,9 +55,14 @@ class BaseGAN(lc.GlobalLoggingClass):
             and not discriminator_load_path.lower() == "null"
             and not discriminator_load_path.lower() == "none"
         ):
-            self.D.load_state_dict(
-                torch.load(discriminator_load_path, map_location="cpu")
-            )
+            if self.D is None:
+                self.status_logs.append(
+                    f"GAN: no discriminator is used, not loading {discriminator_load_path}"
+                )
+            else:
+                self.D.load_state_dict(
+                    torch.load(discriminator_load_path, map_location="cpu")
+                )
             self.G.eval()
         if (
             not state_load_path is None
@@ -76,6 +82,9 @@ class BaseGAN(lc.GlobalLoggingClass):
                 self.optimizers[i].load_state_dict(o)
             for i, s in enumerate(loaded_schedulers):
                 self.schedulers[i].load_state_dict(s)
+            # states saved before mixed precision training have no gradient scalers
+            for i, s in enumerate(state.get("scalers", [])):
+                self.scalers[i].load_state_dict(s)
             return state["epoch"], state["it"]
         return None, None
 
@@ -95,7 +104,7 @@ class BaseGAN(lc.GlobalLoggingClass):
 
         if save_G:
             torch.save(self.G.state_dict(), generator_save_path)
-        if save_D:
+        if save_D and self.D is not None:
             torch.save(self.D.state_dict(), discriminator_save_path)
         if save_state:
             state = {"it": it, "epoch": epoch, "schedulers": [], "optimizers": []}
@@ -103,4 +112,5 @@ class BaseGAN(lc.GlobalLoggingClass):
                 state["schedulers"].append(s.state_dict())
             for o in self.optimizers:
                 state["optimizers"].append(o.state_dict())
+            state["scalers"] = [s.state_dict() for s in self.scalers]
             torch.save(state, state_save_path)
@@ -8,6 +8,7 @@ Implements the ESRDGAN inspired 3D GAN for super resolving wind fields
 
 import math
 import copy
+import functools
 import numpy as np
 import torch
 import torch.nn as nn
@@ -18,8 +19,10 @@ import config.config as config
 from GAN_models.baseGAN import BaseGAN
 from CNN_models.Discriminator_3D import Discriminator_3D
 from CNN_models.Generator_3D_Resnet_ESRGAN import Generator_3D
+from CNN_models.torch_blocks import FACTORIZED_CONV_MODES
 import tools.initialization as initialization
 import tools.trainingtricks as trainingtricks
+from tools.compilation import compile_with_fallback
 from process_data import calculate_gradient_of_wind_field
 
 
@@ -77,6 +80,9 @@ class wind_field_GAN_3D(BaseGAN):
         }
         self.device_check = ""
         self.batch_size: int = 1
+        # a float, or per-sample weights of shape (batch_size,), e.g. importance weights
+        self.loss_weight = 1.0
+        self.train_G_loss_per_sample = torch.zeros(1)
         self.max_diff_squared = torch.tensor(4.0, device=cfg.device)  # HR is in [-1, 1]
         self.epsilon_PSNR = torch.tensor(
             1e-8, device=cfg.device
@@ -89,37 +95,26 @@ class wind_field_GAN_3D(BaseGAN):
         ###################
         cfg_G: config.GeneratorConfig = cfg.generator
         cfg_gan: config.GANConfig = cfg.gan_config
-        self.G = Generator_3D(
-            cfg_G.in_num_ch
-            + cfg_gan.include_pressure
-            + cfg_gan.include_z_channel
-            + cfg_gan.include_above_ground_channel,
-            cfg_G.out_num_ch,
-            cfg_G.num_features,
-            cfg_G.num_RRDB,
-            upscale=cfg.scale,
-            hr_kern_size=cfg_G.hr_kern_size,
-            number_of_RDB_convs=cfg_G.num_RDB_convs,
-            RDB_gc=cfg_G.RDB_growth_chan,
-            lff_kern_size=cfg_G.lff_kern_size,
-            RDB_residual_scaling=cfg_G.RDB_res_scaling,
-            RRDB_residual_scaling=cfg_G.RRDB_res_scaling,
-            act_type=cfg_G.act_type,
-            device=self.device,
-            number_of_z_layers=cfg_gan.number_of_z_layers,
-            conv_mode=cfg_gan.conv_mode,
-            use_mixed_precision=cfg_G.use_mixed_precision,
-            terrain_number_of_features=cfg_G.terrain_number_of_features,
-            dropout_probability=cfg_G.dropout_probability,
-            max_norm=cfg_G.max_norm,
+        # torch.compile traces the RDB convs itself, and can not trace into scripted modules
+        self.G = create_generator(
+            cfg, device=self.device, script_RDB_convs=not cfg_gan.use_torch_compile
         ).to(self.device, non_blocking=True)
 
         initialization.init_weights(self.G, scale=cfg_G.weight_init_scale)
 
         self.conv_mode = cfg_G.conv_mode
         self.use_D_feature_extractor_cost = cfg_gan.use_D_feature_extractor_cost
+        # without adversarial loss and D feature cost, D has no effect on G: it is not built,
+        # and every training iteration is a G iteration
+        self.use_D = bool(
+            cfg.training.adversarial_loss_weight or self.use_D_feature_extractor_cost
+        )
+        if cfg.is_train and not self.use_D:
+            self.status_logs.append(
+                "GAN: adversarial_loss_weight is 0 and use_D_feature_extractor_cost is off - training G without a discriminator"
+            )
 
-        if cfg.is_train:
+        if cfg.is_train and self.use_D:
             cfg_D: config.DiscriminatorConfig = cfg.discriminator
             self.D = Discriminator_3D(
                 cfg_D.in_num_ch,
@@ -130,7 +125,12 @@ class wind_field_GAN_3D(BaseGAN):
                 mode=cfg_D.layer_mode,
                 device=self.device,
                 number_of_z_layers=cfg_gan.number_of_z_layers,
-                conv_mode=cfg_gan.conv_mode,
+                # the factorized conv modes only factorize the generator
+                conv_mode=(
+                    "3D"
+                    if cfg_gan.conv_mode in FACTORIZED_CONV_MODES
+                    else cfg_gan.conv_mode
+                ),
                 use_mixed_precision=cfg_D.use_mixed_precision,
                 enable_slicing=cfg_gan.enable_slicing,
                 dropout_probability=cfg_D.dropout_probability,
@@ -142,6 +142,58 @@ class wind_field_GAN_3D(BaseGAN):
 
             initialization.init_weights(self.D, scale=cfg_D.weight_init_scale)
 
+        if cfg_gan.use_channels_last:
+            if cfg_gan.conv_mode == "2D":
+                self.status_logs.append(
+                    "GAN: warning: use_channels_last is only supported for 3D conv modes - ignoring it"
+                )
+            else:
+                self.G.set_memory_format(torch.channels_last_3d)
+                if self.D is not None:
+                    self.D.set_memory_format(torch.channels_last_3d)
+
+        # G and D stay the plain modules, for loading, saving and switching train/eval
+        self.run_G = compile_with_fallback(
+            self.G, "G", cfg_gan.use_torch_compile, cfg_gan.torch_compile_mode
+        )
+        self.run_D = (
+            compile_with_fallback(
+                self.D, "D", cfg_gan.use_torch_compile, cfg_gan.torch_compile_mode
+            )
+            if self.D is not None
+            else None
+        )
+        self.physics_losses = compile_with_fallback(
+            physics_losses,
+            "physics losses",
+            cfg_gan.use_torch_compile,
+            cfg_gan.torch_compile_mode,
+        )
+
+        # G and D run under autocast with use_mixed_precision. Their outputs are cast back to
+        # float32, so the losses, with the divisions of the physics losses, and PSNR stay in float32
+        self.autocast_dtype = autocast_dtype(cfg_gan, self.device)
+        self.autocast_G = functools.partial(
+            torch.autocast,
+            self.device.type,
+            dtype=self.autocast_dtype,
+            enabled=bool(cfg_G.use_mixed_precision),
+        )
+        self.autocast_D = functools.partial(
+            torch.autocast,
+            self.device.type,
+            dtype=self.autocast_dtype,
+            enabled=bool(cfg.discriminator.use_mixed_precision),
+        )
+        for name, enabled in (
+            ("G", cfg_G.use_mixed_precision),
+            ("D", cfg.is_train and cfg.discriminator.use_mixed_precision),
+        ):
+            if enabled:
+                self.status_logs.append(
+                    f"GAN: running {name} under {self.autocast_dtype} autocast (use_mixed_precision)"
+                )
+
         ###################
         # Define optimizers, schedulers, and losses
         ###################
@@ -154,32 +206,44 @@ class wind_field_GAN_3D(BaseGAN):
                 weight_decay=cfg_t.adam_weight_decay_g,
                 betas=(cfg_t.adam_beta1_g, 0.999),
             )
-            self.optimizer_D = torch.optim.Adam(
-                self.D.parameters(),
-                lr=cfg_t.learning_rate_d,
-                weight_decay=cfg_t.adam_weight_decay_d,
-                betas=(cfg_t.adam_beta1_d, 0.999),
-            )
             self.optimizers.append(self.optimizer_G)
-            self.optimizers.append(self.optimizer_D)
+            if self.D is not None:
+                self.optimizer_D = torch.optim.Adam(
+                    self.D.parameters(),
+                    lr=cfg_t.learning_rate_d,
+                    weight_decay=cfg_t.adam_weight_decay_d,
+                    betas=(cfg_t.adam_beta1_d, 0.999),
+                )
+                self.optimizers.append(self.optimizer_D)
+
+            # float16 gradients underflow without loss scaling, bfloat16 has the range of float32
+            use_scaler = (
+                self.device.type == "cuda" and self.autocast_dtype == torch.float16
+            )
+            self.scaler_G = torch.cuda.amp.GradScaler(
+                enabled=use_scaler and bool(cfg_G.use_mixed_precision)
+            )
+            self.scalers.append(self.scaler_G)
+            if self.D is not None:
+                self.scaler_D = torch.cuda.amp.GradScaler(
+                    enabled=use_scaler and bool(cfg.discriminator.use_mixed_precision)
+                )
+                self.scalers.append(self.scaler_D)
 
             if cfg_t.multistep_lr_steps:
                 self.scheduler_G = lr_scheduler.MultiStepLR(
                     self.optimizer_G, cfg_t.multistep_lr_steps, gamma=cfg_t.lr_gamma
                 )
-                self.scheduler_D = lr_scheduler.MultiStepLR(
-                    self.optimizer_D, cfg_t.multistep_lr_steps, gamma=cfg_t.lr_gamma
-                )
                 self.schedulers.append(self.scheduler_G)
-                self.schedulers.append(self.scheduler_D)
+                if self.D is not None:
+                    self.scheduler_D = lr_scheduler.MultiStepLR(
+                        self.optimizer_D,
+                        cfg_t.multistep_lr_steps,
+                        gamma=cfg_t.lr_gamma,
+                    )
+                    self.schedulers.append(self.scheduler_D)
 
             # pixel loss
-            self.gradient_xy_criterion = nn.MSELoss().to(cfg.device, non_blocking=True)
-            self.gradient_z_criterion = nn.MSELoss().to(cfg.device, non_blocking=True)
-            self.divergence_criterion = nn.MSELoss().to(cfg.device, non_blocking=True)
-            self.xy_divergence_criterion = nn.MSELoss().to(
-                cfg.device, non_blocking=True
-            )
             self.feature_D_criterion = nn.MSELoss().to(cfg.device, non_blocking=True)
 
             if cfg_t.pixel_criterion is None or cfg_t.pixel_criterion == "none":
@@ -193,6 +257,16 @@ class wind_field_GAN_3D(BaseGAN):
                     f"Only l1 and l2 (MSE) loss have been implemented for pixel loss, not {cfg_t.pixel_criterion}"
                 )
 
+            if cfg_t.step_mode not in {"alternating", "shared_forward"}:
+                raise NotImplementedError(
+                    f"Only alternating and shared_forward step modes are implemented, not {cfg_t.step_mode}"
+                )
+
+            if cfg_t.fused_D_batchnorm not in {"per_half", "joint"}:
+                raise NotImplementedError(
+                    f"Only per_half and joint batch norm statistics are implemented for fused D forwards, not {cfg_t.fused_D_batchnorm}"
+                )
+
             # GAN adversarial loss
             if cfg_t.gan_type == "relativistic" or cfg_t.gan_type == "relativisticavg":
                 self.criterion = nn.BCEWithLogitsLoss().to(
@@ -244,10 +318,12 @@ class wind_field_GAN_3D(BaseGAN):
                 )
                 + str(self.device)
             )
+        if self.cfg.training.fuse_D_forward:
+            return self.D_forward_fused(HR, fake_HR, it, train_D)
         if train_D:
             self.D.train()
             if self.cfg.training.use_instance_noise:
-                y_pred = self.D(
+                y_pred = self.run_D(
                     HR
                     + trainingtricks.instance_noise(
                         torch.tensor(1.0, device=self.device),
@@ -257,7 +333,7 @@ class wind_field_GAN_3D(BaseGAN):
                         device=self.device,
                     )
                 ).squeeze()
-                fake_y_pred = self.D(
+                fake_y_pred = self.run_D(
                     fake_HR.detach()
                     + trainingtricks.instance_noise(
                         torch.tensor(1.0, device=self.device),
@@ -268,13 +344,13 @@ class wind_field_GAN_3D(BaseGAN):
                     )
                 ).squeeze()  # detach -> avoid BP to G
             else:
-                y_pred = self.D(HR).squeeze()
-                fake_y_pred = self.D(fake_HR.detach()).squeeze()
+                y_pred = self.run_D(HR).squeeze()
+                fake_y_pred = self.run_D(fake_HR.detach()).squeeze()
         else:
             self.D.eval()
             if self.cfg.training.use_instance_noise:
                 y_pred = (
-                    self.D(
+                    self.run_D(
                         HR
                         + trainingtricks.instance_noise(
                             torch.tensor(2.0, device=self.device),
@@ -287,7 +363,7 @@ class wind_field_GAN_3D(BaseGAN):
                     .squeeze()
                     .detach()
                 )
-                fake_y_pred = self.D(
+                fake_y_pred = self.run_D(
                     fake_HR
                     + trainingtricks.instance_noise(
                         torch.tensor(2.0, device=self.device),
@@ -298,10 +374,44 @@ class wind_field_GAN_3D(BaseGAN):
                     )
                 ).squeeze()
             else:
-                y_pred = self.D(HR).squeeze().detach()
-                fake_y_pred = self.D(fake_HR).squeeze()
+                y_pred = self.run_D(HR).squeeze().detach()
+                fake_y_pred = self.run_D(fake_HR).squeeze()
 
-        return y_pred, fake_y_pred
+        return y_pred.float(), fake_y_pred.float()
+
+    def D_forward_fused(
+        self,
+        HR: torch.Tensor,
+        fake_HR: torch.Tensor,
+        it: torch.Tensor,
+        train_D: bool,
+    ):
+        """
+        D_forward in one D forward on HR and fake_HR concatenated along the batch, with one
+        instance noise draw for both. In D steps, the batch norms of D use per-half statistics,
+        as separate forwards would, or joint statistics, by training.fused_D_batchnorm.
+        """
+        self.D.train(train_D)
+        # D steps do not backpropagate to G
+        x = torch.cat((HR, fake_HR.detach() if train_D else fake_HR))
+        if self.cfg.training.use_instance_noise:
+            x = x + trainingtricks.instance_noise(
+                torch.tensor(1.0 if train_D else 2.0, device=self.device),
+                x.size(),
+                it,
+                self.niter,
+                device=self.device,
+            )
+        if train_D and self.cfg.training.fused_D_batchnorm == "per_half":
+            self.D.split_batch_norm(2)
+        try:
+            y = self.run_D(x)
+        finally:
+            self.D.split_batch_norm(1)
+        y_pred, fake_y_pred = y[: HR.shape[0]].squeeze(), y[HR.shape[0] :].squeeze()
+        if not train_D:
+            y_pred = y_pred.detach()
+        return y_pred.float(), fake_y_pred.float()
 
     def log_G_losses(
         self,
@@ -348,19 +458,37 @@ class wind_field_GAN_3D(BaseGAN):
         fake_y_pred,
         training_iteration: bool,
     ):
+        # with per-sample loss weights, every loss is computed per sample, shape (batch_size,),
+        # and the weighted losses are averaged over the batch before backpropagation
+        per_sample = training_iteration and torch.is_tensor(self.loss_weight)
+        reduce = (
+            functools.partial(per_sample_loss, batch_size=HR.shape[0])
+            if per_sample
+            else lambda criterion, input, target: criterion(input, target)
+        )
+
         loss_G_adversarial = 0
 
-        if self.cfg.training.gan_type == "dcgan":
-            loss_G_adversarial = self.criterion(
-                fake_y_pred, self.HR_labels
-            ) + self.criterion(y_pred, self.fake_HR_labels)
-        if self.cfg.training.gan_type == "relativistic":
-            loss_G_adversarial = self.criterion(fake_y_pred - y_pred, self.HR_labels)
+        if y_pred is None:
+            # no discriminator
+            loss_G_adversarial = torch.zeros(1, device=self.device)
+        elif self.cfg.training.gan_type == "dcgan":
+            loss_G_adversarial = reduce(
+                self.criterion, fake_y_pred, self.HR_labels
+            ) + reduce(self.criterion, y_pred, self.fake_HR_labels)
+        elif self.cfg.training.gan_type == "relativistic":
+            loss_G_adversarial = reduce(
+                self.criterion, fake_y_pred - y_pred, self.HR_labels
+            )
 
         elif self.cfg.training.gan_type == "relativisticavg":
             loss_G_adversarial = (
-                self.criterion(fake_y_pred - torch.mean(y_pred), self.HR_labels)
-                + self.criterion(y_pred - torch.mean(fake_y_pred), self.fake_HR_labels)
+                reduce(self.criterion, fake_y_pred - torch.mean(y_pred), self.HR_labels)
+                + reduce(
+                    self.criterion,
+                    y_pred - torch.mean(fake_y_pred),
+                    self.fake_HR_labels,
+                )
             ) / 2.0
         else:
             raise NotImplementedError(
@@ -370,57 +498,28 @@ class wind_field_GAN_3D(BaseGAN):
         loss_G_feature_D = torch.zeros(1, device=self.device)
 
         if self.feature_extractor is not None:
-            features = self.feature_extractor(HR).detach()
-            fake_features = self.feature_extractor(fake_HR)
-            loss_G_feature_D = self.feature_D_criterion(features, fake_features)
+            with self.autocast_D():
+                features = self.feature_extractor(HR).detach().float()
+                fake_features = self.feature_extractor(fake_HR).float()
+            loss_G_feature_D = reduce(self.feature_D_criterion, features, fake_features)
 
         loss_G_pix = torch.zeros(1, device=self.device)
         if self.pixel_criterion:
-            loss_G_pix = self.pixel_criterion(HR, fake_HR)
-
-        HR_wind_gradient = calculate_gradient_of_wind_field(
-            HR[:, :3], self.x, self.y, Z
-        )
-        SR_wind_gradient = calculate_gradient_of_wind_field(
-            fake_HR[:, :3], self.x, self.y, Z
-        )
+            loss_G_pix = reduce(self.pixel_criterion, HR, fake_HR)
 
+        # x and y may cover a larger domain than the (sliced) fields, spacing is regular
         (
-            max_xy_gradient,
-            max_z_gradient,
-            max_divergence,
-            max_xy_divergence,
-        ) = get_norm_factors_of_gradients(HR_wind_gradient, SR_wind_gradient)
-
-        loss_G_xy_gradient = self.gradient_xy_criterion(
-            SR_wind_gradient[:, :6] / max_xy_gradient,
-            HR_wind_gradient[:, :6] / max_xy_gradient,
-        )
-        loss_G_z_gradient = self.gradient_z_criterion(
-            SR_wind_gradient[:, 6:] / max_z_gradient,
-            HR_wind_gradient[:, 6:] / max_z_gradient,
-        )
-
-        loss_G_divergence = self.divergence_criterion(
-            (
-                HR_wind_gradient[:, 0, :, :, :]
-                + HR_wind_gradient[:, 4, :, :, :]
-                + HR_wind_gradient[:, 8, :, :, :]
-            )
-            / max_divergence,
-            (
-                SR_wind_gradient[:, 0, :, :, :]
-                + SR_wind_gradient[:, 4, :, :, :]
-                + SR_wind_gradient[:, 8, :, :, :]
-            )
-            / max_divergence,
-        )
-
-        loss_G_xy_divergence = self.xy_divergence_criterion(
-            (HR_wind_gradient[:, 0, :, :, :] + HR_wind_gradient[:, 4, :, :, :])
-            / max_xy_divergence,
-            (SR_wind_gradient[:, 0, :, :, :] + SR_wind_gradient[:, 4, :, :, :])
-            / max_xy_divergence,
+            loss_G_xy_gradient,
+            loss_G_z_gradient,
+            loss_G_divergence,
+            loss_G_xy_divergence,
+        ) = self.physics_losses(
+            HR,
+            fake_HR,
+            self.x[: HR.shape[2]],
+            self.y[: HR.shape[3]],
+            Z,
+            reduction="none" if per_sample else "mean",
         )
 
         loss_G_adversarial *= self.cfg.training.adversarial_loss_weight
@@ -431,15 +530,14 @@ class wind_field_GAN_3D(BaseGAN):
         loss_G_divergence *= self.cfg.training.divergence_loss_weight
         loss_G_xy_divergence *= self.cfg.training.xy_divergence_loss_weight
 
-        if (
-            loss_G_divergence.isnan()
-            or loss_G_xy_divergence.isnan()
-            or loss_G_z_gradient.isnan()
-            or loss_G_xy_gradient.isnan()
-            or loss_G_divergence.isinf()
-            or loss_G_xy_divergence.isinf()
-            or loss_G_z_gradient.isinf()
-            or loss_G_xy_gradient.isinf()
+        if not all(
+            torch.isfinite(loss).all()
+            for loss in (
+                loss_G_divergence,
+                loss_G_xy_divergence,
+                loss_G_z_gradient,
+                loss_G_xy_gradient,
+            )
         ):
             loss_G = loss_G_adversarial + loss_G_pix + loss_G_feature_D
         else:
@@ -453,11 +551,37 @@ class wind_field_GAN_3D(BaseGAN):
                 + loss_G_feature_D
             )
         if training_iteration:
-            loss_G.backward()
-            if not (loss_G.isnan() or loss_G.isinf()):
+            self.scaler_G.scale((loss_G * self.loss_weight).mean()).backward()
+            if torch.isfinite(loss_G).all():
                 total_norm = 0
                 # torch.nn.utils.clip_grad_norm_(self.G.parameters(), self.G.max_norm)
-                self.optimizer_G.step()
+                self.scaler_G.step(self.optimizer_G)
+                self.scaler_G.update()
+
+        if per_sample:
+            self.train_G_loss_per_sample = loss_G.detach()
+            (
+                loss_G,
+                loss_G_adversarial,
+                loss_G_pix,
+                loss_G_xy_gradient,
+                loss_G_z_gradient,
+                loss_G_divergence,
+                loss_G_xy_divergence,
+                loss_G_feature_D,
+            ) = (
+                loss.mean()
+                for loss in (
+                    loss_G,
+                    loss_G_adversarial,
+                    loss_G_pix,
+                    loss_G_xy_gradient,
+                    loss_G_z_gradient,
+                    loss_G_divergence,
+                    loss_G_xy_divergence,
+                    loss_G_feature_D,
+                )
+            )
 
         self.log_G_losses(
             fake_HR,
@@ -476,15 +600,15 @@ class wind_field_GAN_3D(BaseGAN):
     def update_G(self, LR, HR, Z, it, training_iteration: bool):
         if training_iteration:
             self.G.train()
-            fake_HR = self.G(LR, Z)
-
-            for param in self.D.parameters():
-                param.requires_grad = False
-
+            fake_HR = self.generate(LR, Z)
             self.G.zero_grad(set_to_none=True)
 
-            # with torch.autocast(self.device.type, enabled=self.cfg.discriminator.use_mixed_precision):
-            y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=False)
+            y_pred, fake_y_pred = None, None
+            if self.D is not None:
+                for param in self.D.parameters():
+                    param.requires_grad = False
+                with self.autocast_D():
+                    y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=False)
             self.calculate_optimize_and_log_G_loss(
                 HR, fake_HR, Z, y_pred, fake_y_pred, training_iteration
             )
@@ -492,8 +616,13 @@ class wind_field_GAN_3D(BaseGAN):
         else:
             self.G.eval()
             with torch.no_grad():
-                fake_HR = self.G(LR, Z)
-                y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=False)
+                fake_HR = self.generate(LR, Z)
+                y_pred, fake_y_pred = None, None
+                if self.D is not None:
+                    with self.autocast_D():
+                        y_pred, fake_y_pred = self.D_forward(
+                            HR, fake_HR, it, train_D=False
+                        )
                 self.calculate_optimize_and_log_G_loss(
                     HR, fake_HR, Z, y_pred, fake_y_pred, training_iteration
                 )
@@ -537,9 +666,10 @@ class wind_field_GAN_3D(BaseGAN):
                 param.requires_grad = True
                 self.optimizer_D.zero_grad(set_to_none=True)
 
-            y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=True)
+            with self.autocast_D():
+                y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=True)
         else:
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast_D():
                 y_pred, fake_y_pred = self.D_forward(HR, fake_HR, it, train_D=True)
 
         loss_D = None
@@ -562,8 +692,9 @@ class wind_field_GAN_3D(BaseGAN):
             )
 
         if training_epoch:
-            loss_D.backward()
-            self.optimizer_D.step()
+            self.scaler_D.scale(loss_D).backward()
+            self.scaler_D.step(self.optimizer_D)
+            self.scaler_D.update()
 
         self.log_D_losses(loss_D, y_pred, fake_y_pred, training_epoch=training_epoch)
 
@@ -582,18 +713,25 @@ class wind_field_GAN_3D(BaseGAN):
             for param in self.feature_extractor.parameters():
                 param.requires_grad = False
 
-        train_period = it // self.d_g_train_period
         if training_iteration:
-            if train_period % (self.d_g_train_ratio + 1) == 0:
+            if self.is_G_iteration(it):
                 fake_HR = self.update_G(LR, HR, Z, it, training_iteration)
             else:
                 with torch.no_grad():
                     self.G.eval()
-                    fake_HR = self.G(LR, Z)
-                self.update_D(HR, fake_HR, it, training_iteration)
+                    fake_HR = self.generate(LR, Z)
+            # with step_mode shared_forward, every iteration steps G once and D d_g_train_ratio
+            # times, all D steps on the detached fake_HR of the G update, computed before the G step
+            if self.cfg.training.step_mode == "shared_forward":
+                if self.is_D_iteration(it):
+                    for _ in range(self.d_g_train_ratio):
+                        self.update_D(HR, fake_HR.detach(), it, training_iteration)
+            elif self.is_D_iteration(it):
+                self.update_D(HR, fake_HR.detach(), it, training_iteration)
         else:
             fake_HR = self.update_G(LR, HR, Z, it, training_iteration)
-            self.update_D(HR, fake_HR, it, training_iteration)
+            if self.D is not None:
+                self.update_D(HR, fake_HR, it, training_iteration)
             (
                 self.metrics_dict["val_PSNR"],
                 self.metrics_dict["Trilinear_PSNR"],
@@ -618,7 +756,43 @@ class wind_field_GAN_3D(BaseGAN):
             )
         return
 
-    def optimize_parameters(self, LR, HR, Z, it):
+    def generate(self, LR, Z):
+        """run_G(LR, Z), under autocast with use_mixed_precision, in float32"""
+        with self.autocast_G():
+            return self.run_G(LR, Z).float()
+
+    def generate_mc_dropout(
+        self, LR, Z, number_of_samples: int, samples_per_batch: int = 0
+    ):
+        """Mean and standard deviation of G.forward_mc_dropout, under autocast with use_mixed_precision, in float32"""
+        with self.autocast_G():
+            mean, std = self.G.forward_mc_dropout(
+                LR, Z, number_of_samples, samples_per_batch
+            )
+        return mean.float(), std.float()
+
+    def is_G_iteration(self, it) -> bool:
+        """
+        G steps in one window of d_g_train_period iterations, followed by d_g_train_ratio
+        windows of D steps. With step_mode shared_forward, G steps in every iteration, and D
+        steps d_g_train_ratio times on its fake field, so G:D stays 1:d_g_train_ratio without
+        G forwards of its own.
+        """
+        if self.cfg.training.step_mode == "shared_forward":
+            return True
+        return not self.is_D_iteration(it)
+
+    def is_D_iteration(self, it) -> bool:
+        if self.D is None or self.d_g_train_ratio == 0:
+            return False
+        if self.cfg.training.step_mode == "shared_forward":
+            return True
+        return bool((it // self.d_g_train_period) % (self.d_g_train_ratio + 1) != 0)
+
+    def optimize_parameters(self, LR, HR, Z, it, loss_weight=1.0):
+        # loss_weight scales the G loss before backpropagation: a float, or a tensor of
+        # per-sample weights, e.g. importance weights, which also stores the per-sample losses
+        self.loss_weight = loss_weight
         self.compute_losses_and_optimize(LR, HR, Z, it, training_iteration=True)
 
     def validation(self, LR, HR, Z, it):
@@ -680,6 +854,10 @@ class wind_field_GAN_3D(BaseGAN):
     def get_G_train_loss_dict_ref(self):
         return self.train_G_loss_dict
 
+    def get_G_train_loss_per_sample_ref(self):
+        """Per-sample total G loss of the last G step with per-sample loss weights"""
+        return self.train_G_loss_per_sample
+
     def get_G_val_loss_dict_ref(self):
         return self.validation_G_loss_dict
 
@@ -701,13 +879,19 @@ class wind_field_GAN_3D(BaseGAN):
         count_params returns the number of parameter in the G, D, and F of the GAN (in that order)
         """
         G_params = sum(par.numel() for par in self.G.parameters())
-        D_params = sum(par.numel() for par in self.D.parameters())
+        D_params = (
+            sum(par.numel() for par in self.D.parameters()) if self.D is not None else 0
+        )
         # F_params = sum(par.numel() for par in self.F.parameters())
         return G_params, D_params
 
     def count_trainable_params(self) -> tuple[int, int]:
         G_params = sum(par.numel() for par in self.G.parameters() if par.requires_grad)
-        D_params = sum(par.numel() for par in self.D.parameters() if par.requires_grad)
+        D_params = (
+            sum(par.numel() for par in self.D.parameters() if par.requires_grad)
+            if self.D is not None
+            else 0
+        )
         # F_params = sum(par.numel() for par in self.F.parameters() if par.requires_grad)
         return G_params, D_params
 
@@ -718,8 +902,12 @@ class wind_field_GAN_3D(BaseGAN):
             f"*---------------*\nGenerator:\n{G_params} params, {G_params_t} trainable\n\n"
             + str(self.G)
             + "\n\n"
-            + f"*---------------*\nDiscriminator:\n{D_params} params, {D_params_t} trainable\n\n"
-            + str(self.D)
+            + (
+                f"*---------------*\nDiscriminator:\n{D_params} params, {D_params_t} trainable\n\n"
+                + str(self.D)
+                if self.D is not None
+                else "*---------------*\nDiscriminator: not used\n"
+            )
             # + "\n\n"
             # + f"*---------------*\nFeature Extractor (Perceptual network):\n{F_params} params, {F_params_t} trainable\n\n"
             # + str(self.F)
@@ -727,6 +915,62 @@ class wind_field_GAN_3D(BaseGAN):
         )
 
 
+def generator_arguments(
+    cfg_G: config.GeneratorConfig, cfg_gan: config.GANConfig, scale: int
+) -> dict:
+    """Keyword arguments of the Generator_3D described by a generator and GAN config"""
+    return dict(
+        in_channels=cfg_G.in_num_ch
+        + cfg_gan.include_pressure
+        + cfg_gan.include_z_channel
+        + cfg_gan.include_above_ground_channel,
+        out_channels=cfg_G.out_num_ch,
+        number_of_features=cfg_G.num_features,
+        number_of_RRDBs=cfg_G.num_RRDB,
+        upscale=scale,
+        hr_kern_size=cfg_G.hr_kern_size,
+        number_of_RDB_convs=cfg_G.num_RDB_convs,
+        RDB_gc=cfg_G.RDB_growth_chan,
+        lff_kern_size=cfg_G.lff_kern_size,
+        RDB_residual_scaling=cfg_G.RDB_res_scaling,
+        RRDB_residual_scaling=cfg_G.RRDB_res_scaling,
+        act_type=cfg_G.act_type,
+        number_of_z_layers=cfg_gan.number_of_z_layers,
+        conv_mode=cfg_gan.conv_mode,
+        use_mixed_precision=cfg_G.use_mixed_precision,
+        terrain_number_of_features=cfg_G.terrain_number_of_features,
+        dropout_probability=cfg_G.dropout_probability,
+        max_norm=cfg_G.max_norm,
+        checkpoint_RRDBs=cfg_G.checkpoint_RRDBs,
+        upsampler_type=cfg_G.upsampler_type,
+        dense_block_mode=cfg_G.dense_block_mode,
+        cache_scripted_RDB_convs=cfg_G.cache_scripted_RDB_convs,
+    )
+
+
+def autocast_dtype(cfg_gan: config.GANConfig, device: torch.device) -> torch.dtype:
+    """mixed_precision_dtype on cuda, bfloat16 on the cpu, where autocast does not support float16"""
+    if device.type != "cuda":
+        return torch.bfloat16
+    if cfg_gan.mixed_precision_dtype not in {"float16", "bfloat16"}:
+        raise NotImplementedError(
+            f"Unknown mixed precision dtype {cfg_gan.mixed_precision_dtype}"
+        )
+    return getattr(torch, cfg_gan.mixed_precision_dtype)
+
+
+def create_generator(
+    cfg: config.Config, device: torch.device = torch.device("cpu"), **kwargs
+) -> Generator_3D:
+    """
+    Builds the Generator_3D described by cfg, kwargs override its arguments,
+    e.g. exports trace dense_block_mode concat
+    """
+    arguments = generator_arguments(cfg.generator, cfg.gan_config, cfg.scale)
+    arguments.update(device=device, **kwargs)
+    return Generator_3D(**arguments)
+
+
 def calculate_PSNR(
     HR: torch.Tensor,
     fake_HR: torch.Tensor,
@@ -770,6 +1014,77 @@ def compute_PSNR_for_SR_and_trilinear(
         return val_PSNR
 
 
+def per_sample_loss(
+    criterion: nn.Module, input: torch.Tensor, target: torch.Tensor, batch_size: int
+) -> torch.Tensor:
+    """
+    criterion(input, target) of every sample, shape (batch_size,): the unreduced loss averaged
+    over every dimension but the batch. Its mean over the batch is the mean reduced loss.
+    """
+    unreduced_criterion = copy.copy(criterion)
+    unreduced_criterion.reduction = "none"
+    return unreduced_criterion(input, target).reshape(batch_size, -1).mean(dim=1)
+
+
+def physics_losses(HR, fake_HR, x, y, Z, reduction: str = "mean"):
+    """
+    Unweighted MSE losses between the xy gradients, z gradients, divergence and xy divergence
+    of the SR and HR wind fields, each normalized by the max over HR (and SR / 100).
+    With reduction none, the losses of every sample, with the normalization of the batch.
+    """
+
+    def mse_loss(input, target):
+        if reduction == "none":
+            return (
+                nn.functional.mse_loss(input, target, reduction="none")
+                .flatten(1)
+                .mean(dim=1)
+            )
+        return nn.functional.mse_loss(input, target)
+
+    HR_wind_gradient = calculate_gradient_of_wind_field(HR[:, :3], x, y, Z)
+    SR_wind_gradient = calculate_gradient_of_wind_field(fake_HR[:, :3], x, y, Z)
+
+    (
+        max_xy_gradient,
+        max_z_gradient,
+        max_divergence,
+        max_xy_divergence,
+    ) = get_norm_factors_of_gradients(HR_wind_gradient, SR_wind_gradient)
+
+    loss_xy_gradient = mse_loss(
+        SR_wind_gradient[:, :6] / max_xy_gradient,
+        HR_wind_gradient[:, :6] / max_xy_gradient,
+    )
+    loss_z_gradient = mse_loss(
+        SR_wind_gradient[:, 6:] / max_z_gradient,
+        HR_wind_gradient[:, 6:] / max_z_gradient,
+    )
+
+    loss_divergence = mse_loss(
+        (
+            HR_wind_gradient[:, 0, :, :, :]
+            + HR_wind_gradient[:, 4, :, :, :]
+            + HR_wind_gradient[:, 8, :, :, :]
+        )
+        / max_divergence,
+        (
+            SR_wind_gradient[:, 0, :, :, :]
+            + SR_wind_gradient[:, 4, :, :, :]
+            + SR_wind_gradient[:, 8, :, :, :]
+        )
+        / max_divergence,
+    )
+
+    loss_xy_divergence = mse_loss(
+        (HR_wind_gradient[:, 0, :, :, :] + HR_wind_gradient[:, 4, :, :, :])
+        / max_xy_divergence,
+        (SR_wind_gradient[:, 0, :, :, :] + SR_wind_gradient[:, 4, :, :, :])
+        / max_xy_divergence,
+    )
+    return loss_xy_gradient, loss_z_gradient, loss_divergence, loss_xy_divergence
+
+
 @torch.jit.script
 def get_norm_factors_of_gradients(
     HR_wind_gradient: torch.Tensor, SR_wind_gradient: torch.Tensor
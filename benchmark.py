@@ -0,0 +1,889 @@
+"""
+benchmark.py
+Apache License
+
+Throughput benchmarks of the building blocks of wind_field_GAN_3D
+Usage:
+    python benchmark.py < horizontal_conv | checkpointing | memory_format | compile | upsampler | dense_block | mixed_precision | construction | factorized_conv | mc_dropout | fused_D > [ --device cuda ] [ --batch_size 8 ] [ -h ]
+
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+from tabulate import tabulate
+
+from CNN_models.Discriminator_3D import Discriminator_3D
+from CNN_models.Generator_3D_Resnet_ESRGAN import Generator_3D
+from CNN_models.torch_blocks import (
+    Horizontal_Conv_3D,
+    RDB_Horizontal_Conv_3D,
+    forward_horizontal_convs,
+    scripted_RDB_convs,
+)
+from GAN_models.wind_field_GAN_3D import physics_losses
+from tools.generatorcomparison import count_conv_MACs
+from tools.compilation import CompiledWithFallback
+
+
+def time_function(fn, device: torch.device, warmup: int = 3, repeats: int = 10):
+    """Returns the mean wall time of fn() in seconds"""
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def forward_and_backward(module_forward, x):
+    def fn():
+        out = module_forward(x)
+        out.sum().backward()
+
+    return fn
+
+
+def build_generator(args, **kwargs) -> Generator_3D:
+    return Generator_3D(
+        args.in_channels,
+        3,
+        args.num_features,
+        args.num_RRDB,
+        upscale=args.scale,
+        number_of_z_layers=args.number_of_z_layers,
+        conv_mode=args.conv_mode,
+        **kwargs,
+    ).to(torch.device(args.device))
+
+
+def generator_inputs(args):
+    device = torch.device(args.device)
+    LR = torch.randn(
+        args.batch_size,
+        args.in_channels,
+        args.size,
+        args.size,
+        args.number_of_z_layers,
+        device=device,
+    )
+    Z = torch.randn(
+        args.batch_size,
+        1,
+        args.scale * args.size,
+        args.scale * args.size,
+        args.number_of_z_layers,
+        device=device,
+    )
+    return LR, Z
+
+
+def saved_tensor_bytes(fn) -> int:
+    """Bytes of the distinct tensors autograd keeps for the backward pass of fn()"""
+    storages = {}
+
+    def pack(tensor):
+        storages[
+            tensor.untyped_storage().data_ptr()
+        ] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    del out
+    return sum(storages.values())
+
+
+def benchmark_horizontal_conv(args):
+    """
+    Compares the per-level loop (forward_horizontal_convs) to the batched grouped conv
+    used by Horizontal_Conv_3D and RDB_Horizontal_Conv_3D
+    """
+    device = torch.device(args.device)
+    x = torch.randn(
+        args.batch_size,
+        args.channels,
+        args.size,
+        args.size,
+        args.number_of_z_layers,
+        device=device,
+        requires_grad=True,
+    )
+
+    horizontal_conv = Horizontal_Conv_3D(
+        args.channels, args.channels, number_of_z_layers=args.number_of_z_layers
+    ).to(device)
+    rdb_conv = torch.jit.script(
+        RDB_Horizontal_Conv_3D(
+            args.channels, 32, number_of_z_layers=args.number_of_z_layers
+        ).to(device)
+    )
+
+    def looped_horizontal_conv(x):
+        return forward_horizontal_convs(x, horizontal_conv.convs)
+
+    def looped_rdb_conv(x):
+        return torch.cat((x, forward_horizontal_convs(x, rdb_conv.convs)), 1)
+
+    rows = []
+    for name, looped, batched in (
+        ("Horizontal_Conv_3D", looped_horizontal_conv, horizontal_conv),
+        ("RDB_Horizontal_Conv_3D", looped_rdb_conv, rdb_conv),
+    ):
+        with torch.no_grad():
+            max_diff = (looped(x) - batched(x)).abs().max().item()
+            looped_forward = time_function(
+                lambda: looped(x), device, args.warmup, args.repeats
+            )
+            batched_forward = time_function(
+                lambda: batched(x), device, args.warmup, args.repeats
+            )
+        looped_train = time_function(
+            forward_and_backward(looped, x), device, args.warmup, args.repeats
+        )
+        batched_train = time_function(
+            forward_and_backward(batched, x), device, args.warmup, args.repeats
+        )
+        rows.append(
+            [
+                name,
+                args.batch_size / looped_forward,
+                args.batch_size / batched_forward,
+                args.batch_size / looped_train,
+                args.batch_size / batched_train,
+                max_diff,
+            ]
+        )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "module",
+                "loop fwd [samples/s]",
+                "batched fwd [samples/s]",
+                "loop fwd+bwd [samples/s]",
+                "batched fwd+bwd [samples/s]",
+                "max abs diff",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_checkpointing(args):
+    """
+    Step time and memory of a generator training step, checkpointing the activations
+    of every N RRDBs for each N in --checkpoint_RRDBs (0 stores all activations)
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    rows = []
+    for segment_size in args.checkpoint_RRDBs:
+        G = build_generator(args, checkpoint_RRDBs=segment_size).train()
+
+        def step():
+            G(LR, Z).square().mean().backward()
+
+        saved_bytes = saved_tensor_bytes(lambda: G(LR, Z))
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        step_time = time_function(step, device, args.warmup, args.repeats)
+        peak_memory = (
+            torch.cuda.max_memory_allocated(device) / 2**20
+            if device.type == "cuda"
+            else float("nan")
+        )
+        rows.append([segment_size, step_time, saved_bytes / 2**20, peak_memory])
+        del G
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "checkpoint_RRDBs",
+                "step time [s]",
+                "saved activations [MB]",
+                "CUDA peak memory [MB]",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_memory_format(args):
+    """
+    Generator inference and training step time in the default and channels_last_3d
+    memory formats, for each conv mode
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    rows = []
+    for conv_mode in ("3D", "horizontal_3D"):
+        args.conv_mode = conv_mode
+        G = build_generator(args)
+        reference = None
+        for memory_format in (torch.contiguous_format, torch.channels_last_3d):
+            G.set_memory_format(memory_format)
+
+            def step():
+                G(LR, Z).square().mean().backward()
+
+            G.eval()
+            with torch.no_grad():
+                SR = G(LR, Z)
+                reference = SR if reference is None else reference
+                inference_time = time_function(
+                    lambda: G(LR, Z), device, args.warmup, args.repeats
+                )
+            G.train()
+            step_time = time_function(step, device, args.warmup, args.repeats)
+            rows.append(
+                [
+                    conv_mode,
+                    str(memory_format).replace("torch.", ""),
+                    inference_time,
+                    step_time,
+                    (SR - reference).abs().max().item(),
+                ]
+            )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "conv mode",
+                "memory format",
+                "inference [s]",
+                "training step [s]",
+                "max abs diff",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_compile(args):
+    """
+    Compile time and steady state step time of torch.compile against eager execution with
+    scripted RDB convs, for generator inference and for a generator training step with
+    the pixel and physics losses
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    HR = torch.randn(LR.shape[0], 3, *Z.shape[2:], device=device)
+    x = torch.arange(HR.shape[2], dtype=torch.float, device=device)
+    y = torch.arange(HR.shape[3], dtype=torch.float, device=device)
+    heights = torch.cumsum(torch.rand_like(Z) + 0.5, dim=4)
+
+    G_eager = build_generator(args)
+    G = build_generator(args, script_RDB_convs=False)
+    G.load_state_dict(G_eager.state_dict())
+    run_G = CompiledWithFallback(G, "G", args.compile_mode)
+    run_physics_losses = CompiledWithFallback(
+        physics_losses, "physics losses", args.compile_mode
+    )
+
+    def inference(G):
+        with torch.no_grad():
+            return G(LR, Z)
+
+    def training_step(G, losses):
+        def step():
+            SR = G(LR, Z)
+            loss = (SR - HR).abs().mean() + sum(losses(HR, SR, x, y, heights))
+            loss.backward()
+            return SR
+
+        return step
+
+    rows = []
+    for name, mode, eager, compiled in (
+        ("inference", G.eval, lambda: inference(G_eager), lambda: inference(run_G)),
+        (
+            "training step",
+            G.train,
+            training_step(G_eager, physics_losses),
+            training_step(run_G, run_physics_losses),
+        ),
+    ):
+        mode()
+        G_eager.train(G.training)
+        eager_time = time_function(eager, device, args.warmup, args.repeats)
+        start = time.perf_counter()
+        SR = compiled()
+        first_call = time.perf_counter() - start
+        compiled_time = time_function(compiled, device, args.warmup, args.repeats)
+        max_diff = (SR.detach() - eager().detach()).abs().max().item()
+        speedup = eager_time / compiled_time
+        compile_time = first_call - compiled_time
+        rows.append(
+            [
+                name,
+                "compiled" if run_G.compiled is not None else "eager fallback",
+                compile_time,
+                eager_time,
+                compiled_time,
+                speedup,
+                compile_time / (eager_time - compiled_time)
+                if eager_time > compiled_time
+                else float("inf"),
+                max_diff,
+            ]
+        )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "",
+                "G",
+                "compile time [s]",
+                "eager [s]",
+                "compiled [s]",
+                "speedup",
+                "break-even steps",
+                "max abs diff",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_upsampler(args):
+    """
+    Generator parameters, inference and training step time with nearest neighbour + conv
+    and with conv + pixel shuffle upsampling
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    rows = []
+    for upsampler_type in ("nearest", "pixel_shuffle"):
+        G = build_generator(args, upsampler_type=upsampler_type)
+
+        def step():
+            G(LR, Z).square().mean().backward()
+
+        G.eval()
+        with torch.no_grad():
+            inference_time = time_function(
+                lambda: G(LR, Z), device, args.warmup, args.repeats
+            )
+        G.train()
+        step_time = time_function(step, device, args.warmup, args.repeats)
+        rows.append(
+            [
+                upsampler_type,
+                sum(parameter.numel() for parameter in G.parameters()),
+                inference_time,
+                step_time,
+            ]
+        )
+
+    print(
+        tabulate(
+            rows,
+            headers=["upsampler", "G params", "inference [s]", "training step [s]"],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_dense_block(args):
+    """
+    Generator training step time and saved activations with concatenating RDBs and with
+    RDBs writing into a shared feature buffer, and the max abs difference of their outputs
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    rows = []
+    reference = None
+    for dense_block_mode in ("concat", "shared_buffer"):
+        torch.manual_seed(0)
+        G = build_generator(args, dense_block_mode=dense_block_mode).train()
+
+        def step():
+            G(LR, Z).square().mean().backward()
+
+        with torch.no_grad():
+            G.eval()
+            SR = G(LR, Z)
+            reference = SR if reference is None else reference
+            inference_time = time_function(
+                lambda: G(LR, Z), device, args.warmup, args.repeats
+            )
+            G.train()
+        saved_bytes = saved_tensor_bytes(lambda: G(LR, Z))
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        step_time = time_function(step, device, args.warmup, args.repeats)
+        peak_memory = (
+            torch.cuda.max_memory_allocated(device) / 2**20
+            if device.type == "cuda"
+            else float("nan")
+        )
+        rows.append(
+            [
+                dense_block_mode,
+                inference_time,
+                step_time,
+                saved_bytes / 2**20,
+                peak_memory,
+                (SR - reference).abs().max().item(),
+            ]
+        )
+        del G
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "dense block mode",
+                "inference [s]",
+                "training step [s]",
+                "saved activations [MB]",
+                "CUDA peak memory [MB]",
+                "max abs diff",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_mixed_precision(args):
+    """
+    Generator inference and training step time, saved activations and CUDA peak memory in
+    float32 and under bfloat16 (and on cuda float16) autocast, and the loss curves of
+    --loss_curve_steps Adam steps on the pixel and physics losses from the same weights.
+    The losses are computed in float32, as in wind_field_GAN_3D.
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    HR = torch.randn(LR.shape[0], 3, *Z.shape[2:], device=device)
+    x = torch.arange(HR.shape[2], dtype=torch.float, device=device)
+    y = torch.arange(HR.shape[3], dtype=torch.float, device=device)
+    heights = torch.cumsum(torch.rand_like(Z) + 0.5, dim=4)
+    initial_state = build_generator(args).state_dict()
+
+    dtypes = {"float32": None, "bfloat16": torch.bfloat16}
+    if device.type == "cuda":
+        dtypes["float16"] = torch.float16
+    rows, loss_curves = [], {}
+    reference = None
+    for name, dtype in dtypes.items():
+        G = build_generator(args)
+        G.load_state_dict(initial_state)
+
+        def forward():
+            if dtype is None:
+                return G(LR, Z)
+            with torch.autocast(device.type, dtype=dtype):
+                return G(LR, Z).float()
+
+        def loss():
+            SR = forward()
+            return (SR - HR).abs().mean() + sum(physics_losses(HR, SR, x, y, heights))
+
+        scaler = torch.cuda.amp.GradScaler(enabled=dtype == torch.float16)
+
+        def step():
+            G.zero_grad(set_to_none=True)
+            scaler.scale(loss()).backward()
+
+        G.eval()
+        with torch.no_grad():
+            SR = forward()
+            reference = SR if reference is None else reference
+            inference_time = time_function(forward, device, args.warmup, args.repeats)
+        G.train()
+        saved_bytes = saved_tensor_bytes(forward)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        step_time = time_function(step, device, args.warmup, args.repeats)
+        peak_memory = (
+            torch.cuda.max_memory_allocated(device) / 2**20
+            if device.type == "cuda"
+            else float("nan")
+        )
+        rows.append(
+            [
+                name,
+                inference_time,
+                step_time,
+                saved_bytes / 2**20,
+                peak_memory,
+                (SR - reference).abs().max().item(),
+            ]
+        )
+
+        G.load_state_dict(initial_state)
+        optimizer = torch.optim.Adam(G.parameters(), lr=1e-4)
+        loss_curves[name] = []
+        for _ in range(args.loss_curve_steps):
+            optimizer.zero_grad(set_to_none=True)
+            step_loss = loss()
+            scaler.scale(step_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            loss_curves[name].append(step_loss.item())
+        del G
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "autocast",
+                "inference [s]",
+                "training step [s]",
+                "saved activations [MB]",
+                "CUDA peak memory [MB]",
+                "max abs diff",
+            ],
+            floatfmt=".4g",
+        )
+    )
+    steps = sorted(
+        set(range(0, args.loss_curve_steps, max(1, args.loss_curve_steps // 10)))
+        | {args.loss_curve_steps - 1}
+    )
+    print(
+        tabulate(
+            [
+                [step + 1] + [loss_curves[name][step] for name in dtypes]
+                for step in steps
+            ],
+            headers=["step"] + [f"{name} loss" for name in dtypes],
+            floatfmt=".5g",
+        )
+    )
+
+
+def benchmark_construction(args):
+    """
+    Generator construction time with unscripted RDB convs, with every RDB conv scripted,
+    and with scripted RDB convs copied from the cache of one per signature, the first time
+    (cold) and with the cache filled by the first generator (warm)
+    """
+    modes = {
+        "unscripted": dict(script_RDB_convs=False),
+        "scripted": dict(cache_scripted_RDB_convs=False),
+        "cached, cold": dict(cache_scripted_RDB_convs=True),
+        "cached, warm": dict(cache_scripted_RDB_convs=True),
+    }
+    scripted_RDB_convs.clear()
+    rows = []
+    for name, kwargs in modes.items():
+        start = time.perf_counter()
+        build_generator(args, **kwargs)
+        rows.append([name, time.perf_counter() - start])
+
+    print(tabulate(rows, headers=["RDB convs", "construction [s]"], floatfmt=".4g"))
+
+
+def benchmark_factorized_conv(args):
+    """
+    Generator parameters, conv MACs, inference and training step time in the 3D conv mode and
+    the factorized conv modes, and the pixel loss after --loss_curve_steps Adam steps of fitting
+    the trilinear upsampling of the LR wind, as a proxy for how well each mode fits a smooth field.
+    Accuracy on the wind data needs training runs with [GAN] conv_mode.
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    HR = torch.nn.functional.interpolate(
+        LR[:, :3], size=Z.shape[2:], mode="trilinear", align_corners=False
+    )
+    rows = []
+    for conv_mode in ("3D", "factorized_3D", "factorized_depthwise_3D"):
+        torch.manual_seed(0)
+        G = Generator_3D(
+            args.in_channels,
+            3,
+            args.num_features,
+            args.num_RRDB,
+            upscale=args.scale,
+            number_of_z_layers=args.number_of_z_layers,
+            conv_mode=conv_mode,
+            script_RDB_convs=False,
+        ).to(device)
+
+        def loss():
+            return (G(LR, Z) - HR).abs().mean()
+
+        G.eval()
+        MACs = count_conv_MACs(G, LR, Z)
+        with torch.no_grad():
+            inference_time = time_function(
+                lambda: G(LR, Z), device, args.warmup, args.repeats
+            )
+        G.train()
+        step_time = time_function(
+            lambda: loss().backward(), device, args.warmup, args.repeats
+        )
+
+        optimizer = torch.optim.Adam(G.parameters(), lr=1e-4)
+        for _ in range(args.loss_curve_steps):
+            optimizer.zero_grad(set_to_none=True)
+            step_loss = loss()
+            step_loss.backward()
+            optimizer.step()
+        rows.append(
+            [
+                conv_mode,
+                sum(parameter.numel() for parameter in G.parameters()),
+                MACs / 1e9,
+                inference_time,
+                step_time,
+                step_loss.item(),
+            ]
+        )
+        del G
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "conv mode",
+                "G params",
+                "conv GMACs",
+                "inference [s]",
+                "training step [s]",
+                f"pix after {args.loss_curve_steps} steps",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_mc_dropout(args):
+    """
+    Time of --mc_dropout_samples Monte Carlo dropout samples of the generator as separate
+    forwards with the hr conv dropout active, and with forward_mc_dropout, which runs the
+    trunk once, and the max abs difference of their mean and standard deviation fields
+    """
+    device = torch.device(args.device)
+    LR, Z = generator_inputs(args)
+    G = build_generator(
+        args, dropout_probability=args.dropout_probability, script_RDB_convs=False
+    ).eval()
+    number_of_samples = args.mc_dropout_samples
+
+    def separate_forwards():
+        G.hr_convs[1].train()
+        samples = torch.stack([G(LR, Z) for _ in range(number_of_samples)], dim=1)
+        G.hr_convs[1].eval()
+        return samples.mean(dim=1), samples.std(dim=1)
+
+    rows = []
+    with torch.no_grad():
+        reference = separate_forwards()
+        for name, fn in {
+            "separate forwards": separate_forwards,
+            "forward_mc_dropout": lambda: G.forward_mc_dropout(
+                LR, Z, number_of_samples
+            ),
+            "forward_mc_dropout, 1 per batch": lambda: G.forward_mc_dropout(
+                LR, Z, number_of_samples, samples_per_batch=1
+            ),
+        }.items():
+            mean, std = fn()
+            rows.append(
+                [
+                    name,
+                    time_function(fn, device, args.warmup, args.repeats),
+                    (mean - reference[0]).abs().max().item(),
+                    (std - reference[1]).abs().max().item(),
+                    std.mean().item(),
+                ]
+            )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                f"{number_of_samples} samples",
+                "time [s]",
+                "max abs diff mean",
+                "max abs diff std",
+                "mean std",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+def benchmark_fused_D(args):
+    """
+    Discriminator training step time (forward and backward on real and fake fields) with
+    separate forwards and with one fused forward on their concatenation, with per-half and
+    joint batch norm statistics, and the max abs difference of the predictions and of the
+    updated running means to the separate forwards. D dropout is off, so they are comparable.
+    """
+    device = torch.device(args.device)
+    _, Z = generator_inputs(args)
+    HR = torch.randn(Z.shape[0], 3, *Z.shape[2:], device=device)
+    fake_HR = torch.randn_like(HR)
+    conv_mode = "3D" if args.conv_mode != "horizontal_3D" else "horizontal_3D"
+    torch.manual_seed(0)
+    initial_D = Discriminator_3D(
+        3,
+        args.num_features,
+        number_of_z_layers=args.number_of_z_layers,
+        conv_mode=conv_mode,
+    ).to(device)
+
+    def separate(D):
+        return torch.cat((D(HR), D(fake_HR)))
+
+    def fused(batch_norm_splits):
+        def forward(D):
+            D.split_batch_norm(batch_norm_splits)
+            try:
+                return D(torch.cat((HR, fake_HR)))
+            finally:
+                D.split_batch_norm(1)
+
+        return forward
+
+    modes = {
+        "separate forwards": separate,
+        "fused, per_half": fused(2),
+        "fused, joint": fused(1),
+    }
+    rows, reference = [], None
+    for name, forward in modes.items():
+        D = copy.deepcopy(initial_D).train()
+        predictions = forward(D)
+        running_means = torch.cat(
+            [
+                buffer.flatten()
+                for buffer_name, buffer in D.named_buffers()
+                if buffer_name.endswith("running_mean")
+            ]
+        )
+        reference = reference or (predictions, running_means)
+        step_time = time_function(
+            lambda: forward(D).sum().backward(), device, args.warmup, args.repeats
+        )
+        rows.append(
+            [
+                name,
+                step_time,
+                (predictions - reference[0]).abs().max().item(),
+                (running_means - reference[1]).abs().max().item(),
+            ]
+        )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "D forward",
+                "training step [s]",
+                "max abs diff predictions",
+                "max abs diff running means",
+            ],
+            floatfmt=".4g",
+        )
+    )
+
+
+BENCHMARKS = {
+    "horizontal_conv": benchmark_horizontal_conv,
+    "checkpointing": benchmark_checkpointing,
+    "memory_format": benchmark_memory_format,
+    "compile": benchmark_compile,
+    "upsampler": benchmark_upsampler,
+    "dense_block": benchmark_dense_block,
+    "mixed_precision": benchmark_mixed_precision,
+    "construction": benchmark_construction,
+    "factorized_conv": benchmark_factorized_conv,
+    "mc_dropout": benchmark_mc_dropout,
+    "fused_D": benchmark_fused_D,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run throughput benchmarks of wind_field_GAN_3D components."
+    )
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the benchmark on",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--channels",
+        type=int,
+        default=128,
+        help="number of input channels of single conv layers",
+    )
+    parser.add_argument(
+        "--in_channels",
+        type=int,
+        default=5,
+        help="number of input channels of the generator",
+    )
+    parser.add_argument(
+        "--size", type=int, default=64, help="horizontal size of the input"
+    )
+    parser.add_argument("--number_of_z_layers", type=int, default=10)
+    parser.add_argument(
+        "--conv_mode",
+        type=str,
+        default="3D",
+        choices=["3D", "horizontal_3D", "factorized_3D", "factorized_depthwise_3D"],
+        help="conv mode of the generator",
+    )
+    parser.add_argument("--num_features", type=int, default=64)
+    parser.add_argument("--num_RRDB", type=int, default=4)
+    parser.add_argument("--scale", type=int, default=4)
+    parser.add_argument(
+        "--checkpoint_RRDBs",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2],
+        help="RRDB segment sizes to compare in the checkpointing benchmark",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        default="default",
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="torch.compile mode of the compile benchmark",
+    )
+    parser.add_argument(
+        "--loss_curve_steps",
+        type=int,
+        default=50,
+        help="training steps of the loss curves of the mixed_precision and factorized_conv benchmarks",
+    )
+    parser.add_argument(
+        "--mc_dropout_samples",
+        type=int,
+        default=16,
+        help="Monte Carlo dropout samples of the mc_dropout benchmark",
+    )
+    parser.add_argument(
+        "--dropout_probability",
+        type=float,
+        default=0.1,
+        help="hr conv dropout probability of the mc_dropout benchmark",
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
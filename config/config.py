@@ -39,6 +39,10 @@ class GANConfig(IniConfig):
     use_D_feature_extractor_cost = False
     enable_slicing = False
     slice_size = 64
+    use_channels_last = False
+    use_torch_compile = False
+    torch_compile_mode = "default"
+    mixed_precision_dtype = "float16"
 
     def setGANConfig(self, gan_config):
         self.include_pressure = gan_config.getboolean("include_pressure")
@@ -56,6 +60,18 @@ class GANConfig(IniConfig):
         )
         self.enable_slicing = gan_config.getboolean("enable_slicing")
         self.slice_size = gan_config.getint("slice_size")
+        self.use_channels_last = gan_config.getboolean(
+            "use_channels_last", fallback=self.use_channels_last
+        )
+        self.use_torch_compile = gan_config.getboolean(
+            "use_torch_compile", fallback=self.use_torch_compile
+        )
+        self.torch_compile_mode = gan_config.get(
+            "torch_compile_mode", fallback=self.torch_compile_mode
+        )
+        self.mixed_precision_dtype = gan_config.get(
+            "mixed_precision_dtype", fallback=self.mixed_precision_dtype
+        )
 
 
 class EnvConfig(IniConfig):
@@ -69,6 +85,7 @@ class EnvConfig(IniConfig):
     fixed_seed: int = 2001
     this_runs_folder: str = None
     this_runs_tensorboard_folder: str = None
+    exported_generator_path: str = None
 
     def setEnvConfig(self, env_config):
         self.root_path = env_config.get("root_path")
@@ -83,6 +100,7 @@ class EnvConfig(IniConfig):
         self.discriminator_load_path = env_config.get("discriminator_load_path")
         self.state_load_path = env_config.get("state_load_path")
         self.fixed_seed = env_config.getint("fixed_seed")
+        self.exported_generator_path = env_config.get("exported_generator_path")
 
 
 class GeneratorConfig(IniConfig):
@@ -102,10 +120,18 @@ class GeneratorConfig(IniConfig):
     weight_init_scale: float = 1.0
     lff_kern_size: int = 3
     conv_mode: str = "2D"
-    use_mixed_precision: bool = True
+    use_mixed_precision: bool = False
     terrain_number_of_features: int = 16
     dropout_probability: float = 0.0
     max_norm: float = 1.0
+    use_terrain_cache: bool = False
+    terrain_cache_tolerance: float = 0.0
+    terrain_cache_size: int = 16
+    checkpoint_RRDBs: int = 0
+    upsampler_type: str = "nearest"
+    dense_block_mode: str = "concat"
+    cache_scripted_RDB_convs: bool = True
+    inference_backend: str = "pytorch"
 
     def setGeneratorConfig(self, gen_config):
         self.norm_type = gen_config.get("norm_type")
@@ -123,12 +149,38 @@ class GeneratorConfig(IniConfig):
         self.weight_init_scale = gen_config.getfloat("weight_init_scale")
         self.lff_kern_size = gen_config.getint("lff_kern_size")
         self.conv_mode = gen_config.get("conv_mode")
-        self.use_mixed_precision = gen_config.getboolean("use_mixed_precision")
+        self.use_mixed_precision = gen_config.getboolean(
+            "use_mixed_precision", fallback=self.use_mixed_precision
+        )
         self.terrain_number_of_features = gen_config.getint(
             "terrain_number_of_features"
         )
         self.dropout_probability = gen_config.getfloat("dropout_probability")
         self.max_norm = gen_config.getfloat("max_norm")
+        self.use_terrain_cache = gen_config.getboolean(
+            "use_terrain_cache", fallback=self.use_terrain_cache
+        )
+        self.terrain_cache_tolerance = gen_config.getfloat(
+            "terrain_cache_tolerance", fallback=self.terrain_cache_tolerance
+        )
+        self.terrain_cache_size = gen_config.getint(
+            "terrain_cache_size", fallback=self.terrain_cache_size
+        )
+        self.checkpoint_RRDBs = gen_config.getint(
+            "checkpoint_RRDBs", fallback=self.checkpoint_RRDBs
+        )
+        self.upsampler_type = gen_config.get(
+            "upsampler_type", fallback=self.upsampler_type
+        )
+        self.dense_block_mode = gen_config.get(
+            "dense_block_mode", fallback=self.dense_block_mode
+        )
+        self.cache_scripted_RDB_convs = gen_config.getboolean(
+            "cache_scripted_RDB_convs", fallback=self.cache_scripted_RDB_convs
+        )
+        self.inference_backend = gen_config.get(
+            "inference_backend", fallback=self.inference_backend
+        )
 
 
 class DiscriminatorConfig(IniConfig):
@@ -140,7 +192,7 @@ class DiscriminatorConfig(IniConfig):
     feat_kern_size: int = 3
     weight_init_scale: float = 1.0
     conv_mode: str = "3D"
-    use_mixed_precision: bool = True
+    use_mixed_precision: bool = False
     dropout_probability: float = 0.2
 
     def setDiscriminatorConfig(self, disc_config):
@@ -152,7 +204,9 @@ class DiscriminatorConfig(IniConfig):
         self.feat_kern_size = disc_config.getint("feat_kern_size")
         self.weight_init_scale = disc_config.getfloat("weight_init_scale")
         self.conv_mode = disc_config.get("conv_mode")
-        self.use_mixed_precision = disc_config.getboolean("use_mixed_precision")
+        self.use_mixed_precision = disc_config.getboolean(
+            "use_mixed_precision", fallback=self.use_mixed_precision
+        )
         self.dropout_probability = disc_config.getfloat("dropout_probability")
 
 
@@ -188,14 +242,132 @@ class DatasetConfig(IniConfig):
 
 class DatasetTrainConfig(DatasetConfig):
     name: str = "default_dataset_name"
+    pinned_ring_size: int = 0
+
+    def setDatasetConfig(self, data_config):
+        super().setDatasetConfig(data_config)
+        self.pinned_ring_size = data_config.getint(
+            "pinned_ring_size", fallback=self.pinned_ring_size
+        )
 
 
 class DatasetValConfig(DatasetConfig):
     name: str = "default_dataset_name"
+    cache_batches: bool = False
+    cache_memory_budget_MB: int = 1024
+
+    def setDatasetConfig(self, data_config):
+        super().setDatasetConfig(data_config)
+        self.cache_batches = data_config.getboolean(
+            "cache_batches", fallback=self.cache_batches
+        )
+        self.cache_memory_budget_MB = data_config.getint(
+            "cache_memory_budget_MB", fallback=self.cache_memory_budget_MB
+        )
 
 
 class DatasetTestConfig(DatasetConfig):
     name: str = "default_dataset_name"
+    tile_size: int = 0
+    tile_halo: int = -1
+    tiles_per_batch: int = 4
+    report_tiling_error: bool = False
+    mc_dropout_samples: int = 0
+    mc_dropout_samples_per_batch: int = 0
+
+    def setDatasetConfig(self, data_config):
+        super().setDatasetConfig(data_config)
+        self.tile_size = data_config.getint("tile_size", fallback=self.tile_size)
+        self.tile_halo = data_config.getint("tile_halo", fallback=self.tile_halo)
+        self.tiles_per_batch = data_config.getint(
+            "tiles_per_batch", fallback=self.tiles_per_batch
+        )
+        self.report_tiling_error = data_config.getboolean(
+            "report_tiling_error", fallback=self.report_tiling_error
+        )
+        self.mc_dropout_samples = data_config.getint(
+            "mc_dropout_samples", fallback=self.mc_dropout_samples
+        )
+        self.mc_dropout_samples_per_batch = data_config.getint(
+            "mc_dropout_samples_per_batch", fallback=self.mc_dropout_samples_per_batch
+        )
+
+
+class QuantizationConfig(IniConfig):
+    calibration_samples: int = 16
+    backend: str = "fbgemm"
+    report_samples: int = 0
+
+    def setQuantizationConfig(self, quantization_config):
+        self.calibration_samples = quantization_config.getint(
+            "calibration_samples", fallback=self.calibration_samples
+        )
+        self.backend = quantization_config.get("backend", fallback=self.backend)
+        self.report_samples = quantization_config.getint(
+            "report_samples", fallback=self.report_samples
+        )
+
+
+class DistillationConfig(IniConfig):
+    teacher_config_path: str = "pretrained_models/G_best/config.ini"
+    teacher_generator_path: str = None
+    student_num_features: int = 32
+    student_num_RRDB: int = 4
+    feature_loss_weight: float = 1.0
+    teacher_pixel_loss_weight: float = 0.0
+    niter: int = 20000
+    report_samples: int = 0
+
+    def setDistillationConfig(self, distillation_config):
+        self.teacher_config_path = distillation_config.get(
+            "teacher_config_path", fallback=self.teacher_config_path
+        )
+        self.teacher_generator_path = distillation_config.get(
+            "teacher_generator_path", fallback=self.teacher_generator_path
+        )
+        self.student_num_features = distillation_config.getint(
+            "student_num_features", fallback=self.student_num_features
+        )
+        self.student_num_RRDB = distillation_config.getint(
+            "student_num_RRDB", fallback=self.student_num_RRDB
+        )
+        self.feature_loss_weight = distillation_config.getfloat(
+            "feature_loss_weight", fallback=self.feature_loss_weight
+        )
+        self.teacher_pixel_loss_weight = distillation_config.getfloat(
+            "teacher_pixel_loss_weight", fallback=self.teacher_pixel_loss_weight
+        )
+        self.niter = distillation_config.getint("niter", fallback=self.niter)
+        self.report_samples = distillation_config.getint(
+            "report_samples", fallback=self.report_samples
+        )
+
+
+class PruningConfig(IniConfig):
+    criterion: str = "weight_norm"
+    feature_keep_ratio: float = 0.5
+    growth_keep_ratio: float = 0.5
+    calibration_samples: int = 8
+    finetune_niter: int = 2000
+    report_samples: int = 0
+
+    def setPruningConfig(self, pruning_config):
+        self.criterion = pruning_config.get("criterion", fallback=self.criterion)
+        self.feature_keep_ratio = pruning_config.getfloat(
+            "feature_keep_ratio", fallback=self.feature_keep_ratio
+        )
+        self.growth_keep_ratio = pruning_config.getfloat(
+            "growth_keep_ratio", fallback=self.growth_keep_ratio
+        )
+        self.calibration_samples = pruning_config.getint(
+            "calibration_samples", fallback=self.calibration_samples
+        )
+        self.finetune_niter = pruning_config.getint(
+            "finetune_niter", fallback=self.finetune_niter
+        )
+        self.report_samples = pruning_config.getint(
+            "report_samples", fallback=self.report_samples
+        )
 
 
 class TrainingConfig(IniConfig):
@@ -218,6 +390,7 @@ class TrainingConfig(IniConfig):
 
     d_g_train_ratio: int = 1
     d_g_train_period: int = 50
+    step_mode: str = "alternating"
 
     pixel_criterion: str = "l1"
     pixel_loss_weight: float = 1e-1
@@ -233,6 +406,15 @@ class TrainingConfig(IniConfig):
     use_one_sided_label_smoothing: bool = False
     flip_labels: bool = False
     use_instance_noise: bool = False
+    fuse_D_forward: bool = False
+    fused_D_batchnorm: str = "per_half"
+
+    use_importance_sampling: bool = False
+    importance_sampling_uniform_mix: float = 0.5
+    importance_sampling_loss_ema: float = 0.9
+    importance_sampling_regions: int = 1
+
+    slice_size_curriculum: list = []
 
     niter: int = 25  # 5e5
     val_period: int = 2e3
@@ -258,6 +440,7 @@ class TrainingConfig(IniConfig):
         self.adversarial_loss_weight = train_config.getfloat("adversarial_loss_weight")
         self.d_g_train_ratio = train_config.getint("d_g_train_ratio")
         self.d_g_train_period = train_config.getint("d_g_train_period")
+        self.step_mode = train_config.get("step_mode", fallback=self.step_mode)
         self.pixel_criterion = train_config.get("pixel_criterion")
         self.pixel_loss_weight = train_config.getfloat("pixel_loss_weight")
         self.gradient_xy_loss_weight = train_config.getfloat("gradient_xy_loss_weight")
@@ -272,6 +455,12 @@ class TrainingConfig(IniConfig):
             "use_one_sided_label_smoothing"
         )
         self.use_instance_noise = train_config.getboolean("use_instance_noise")
+        self.fuse_D_forward = train_config.getboolean(
+            "fuse_D_forward", fallback=self.fuse_D_forward
+        )
+        self.fused_D_batchnorm = train_config.get(
+            "fused_D_batchnorm", fallback=self.fused_D_batchnorm
+        )
         self.flip_labels = train_config.getboolean("flip_labels")
         self.niter = train_config.getint("niter")
         self.val_period = train_config.getint("val_period")
@@ -280,6 +469,22 @@ class TrainingConfig(IniConfig):
         self.conv_mode = train_config.get("conv_mode")
         self.train_eval_test_ratio = train_config.getfloat("train_eval_test_ratio")
         self.feature_D_update_period = train_config.getint("feature_D_update_period")
+        self.use_importance_sampling = train_config.getboolean(
+            "use_importance_sampling", fallback=self.use_importance_sampling
+        )
+        self.importance_sampling_uniform_mix = train_config.getfloat(
+            "importance_sampling_uniform_mix",
+            fallback=self.importance_sampling_uniform_mix,
+        )
+        self.importance_sampling_loss_ema = train_config.getfloat(
+            "importance_sampling_loss_ema", fallback=self.importance_sampling_loss_ema
+        )
+        self.importance_sampling_regions = train_config.getint(
+            "importance_sampling_regions", fallback=self.importance_sampling_regions
+        )
+        self.slice_size_curriculum = safe_list_from_string(
+            train_config.get("slice_size_curriculum"), list
+        )
 
 
 class Config(IniConfig):
@@ -301,11 +506,19 @@ class Config(IniConfig):
     dataset_test: DatasetTestConfig = DatasetTestConfig()
     dataset_val: DatasetValConfig = DatasetValConfig()
     training: TrainingConfig = TrainingConfig()
+    quantization: QuantizationConfig = QuantizationConfig()
+    distillation: DistillationConfig = DistillationConfig()
+    pruning: PruningConfig = PruningConfig()
     is_train: bool
     is_use: bool
     is_test: bool
     is_param_search: bool
     is_download: bool
+    is_quantize: bool = False
+    is_export_onnx: bool = False
+    is_export_torchscript: bool = False
+    is_distill: bool = False
+    is_prune: bool = False
     slurm_array_id: int = 1
 
     def __init__(self, ini_path):
@@ -330,6 +543,15 @@ class Config(IniConfig):
         training_config = config["TRAINING"]
         self.training.setTrainingConfig(training_config)
 
+        if config.has_section("QUANTIZATION"):
+            self.quantization.setQuantizationConfig(config["QUANTIZATION"])
+
+        if config.has_section("DISTILLATION"):
+            self.distillation.setDistillationConfig(config["DISTILLATION"])
+
+        if config.has_section("PRUNING"):
+            self.pruning.setPruningConfig(config["PRUNING"])
+
         if config.has_section("DATASETTRAIN"):
             dataset_train_config = config["DATASETTRAIN"]
             self.dataset_train.setDatasetConfig(dataset_train_config)
@@ -375,6 +597,9 @@ class Config(IniConfig):
         s += "\n" + str(self.generator)
         s += "\n" + str(self.discriminator)
         s += "\n" + str(self.training)
+        s += "\n" + str(self.quantization)
+        s += "\n" + str(self.distillation)
+        s += "\n" + str(self.pruning)
         if self.dataset_train is not None:
             s += "\n" + str(self.dataset_train)
         if self.dataset_val is not None:
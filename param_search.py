@@ -9,7 +9,7 @@ Use run.py to run.
 
 from ray import tune
 from ray.tune.schedulers import ASHAScheduler
-from train import log_status_logs
+from train import cache_validation_batches, log_status_logs
 import config.config as config
 import logging
 from ray.air import Checkpoint, session
@@ -17,29 +17,29 @@ import torch
 import torch.cuda
 import tensorboardX
 from GAN_models.wind_field_GAN_3D import wind_field_GAN_3D
-from functools import partial
 from ray.tune.search.optuna import OptunaSearch
 from ray.tune.search import ConcurrencyLimiter
-import copy
 import os
 import ray
 
 
 def train_param_search(
-    cfg: config.Config,
-    cfg_env,
-    cfg_gan,
-    cfg_G,
-    cfg_D,
-    cfg_train,
-    cfg_datatrain,
-    cfg_dataval,
-    dataset_train,
-    dataset_validation,
-    x,
-    y,
     search_cfg: dict,
+    cfg: config.Config = None,
+    cfg_env=None,
+    cfg_gan=None,
+    cfg_G=None,
+    cfg_D=None,
+    cfg_train=None,
+    cfg_datatrain=None,
+    cfg_dataval=None,
+    datasets=None,
+    x=None,
+    y=None,
 ):
+    # datasets is fetched from the ray object store by reference, the terrain and
+    # coordinate arrays are zero-copy views shared between all trials on a node
+    dataset_train, dataset_validation = datasets
     cfg.env = cfg_env
     cfg.gan_config = cfg_gan
     cfg.generator = cfg_G
@@ -85,6 +85,7 @@ def train_param_search(
             shuffle=True,
             num_workers=cfg.dataset_train.num_workers,
             pin_memory=True,
+            persistent_workers=cfg.dataset_train.num_workers > 0,
         )
         # dataloader_train = imageset.createDataloader(cfg, is_train_dataloader=True, downsampler_mode="trilinear")
         status_logger.info("finished creating training dataloader and dataset")
@@ -97,8 +98,10 @@ def train_param_search(
             shuffle=False,
             num_workers=cfg.dataset_val.num_workers,
             pin_memory=True,
+            persistent_workers=cfg.dataset_val.num_workers > 0,
         )
         # dataloader_val = imageset.createDataloader(cfg, is_validation_dataloader=True, downsampler_mode="trilinear")
+        dataloader_val = cache_validation_batches(cfg, dataloader_val, status_logger)
         status_logger.info("finished creating validation dataloader and dataset")
     else:
         status_logger.warning(
@@ -387,21 +390,23 @@ def param_search(
 
     # train_param_search(initial_search_config, cfg, dataset_train, dataset_validation, x, y)
 
+    # The processed datasets (store path, file catalog, norm factors and terrain) are
+    # published once to the object store. Both datasets are put as one object so
+    # the arrays they share are only serialized once.
     result = tune.run(
-        partial(
+        tune.with_parameters(
             train_param_search,
-            cfg,
-            cfg.env,
-            cfg.gan_config,
-            cfg.generator,
-            cfg.discriminator,
-            cfg.training,
-            cfg.dataset_train,
-            cfg.dataset_val,
-            copy.deepcopy(dataset_train),
-            copy.deepcopy(dataset_validation),
-            x,
-            y,
+            cfg=cfg,
+            cfg_env=cfg.env,
+            cfg_gan=cfg.gan_config,
+            cfg_G=cfg.generator,
+            cfg_D=cfg.discriminator,
+            cfg_train=cfg.training,
+            cfg_datatrain=cfg.dataset_train,
+            cfg_dataval=cfg.dataset_val,
+            datasets=(dataset_train, dataset_validation),
+            x=x,
+            y=y,
         ),
         resources_per_trial={
             "cpu": cfg.dataset_train.num_workers,
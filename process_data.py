@@ -73,6 +73,8 @@ class CustomizedDataset(torch.utils.data.Dataset):
         self.is_test = is_test
         self.slice_index = 0
         self.filenames = filenames
+        # slice regions per horizontal axis, used when the sampler yields (index, region)
+        self.number_of_slice_regions = 1
 
         if not os.path.exists(
             "./data/full_dataset_files/" + self.subfolder_name + "/max/"
@@ -111,6 +113,9 @@ class CustomizedDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         "Generates one sample of data"
+        region = None
+        if isinstance(index, tuple):
+            index, region = index
         # Select sample
         z, z_above_ground, u, v, w, pressure = pickle.load(
             open(
@@ -158,12 +163,16 @@ class CustomizedDataset(torch.utils.data.Dataset):
             )
 
         if self.enable_slicing:
-            x_start = round(
-                np.random.beta(0.25, 0.25) * (self.x.size - self.slice_size)
-            )
-            y_start = round(
-                np.random.beta(0.25, 0.25) * (self.y.size - self.slice_size)
-            )
+            x_position, y_position = np.random.beta(0.25, 0.25, size=2)
+            if region is not None:
+                x_position = (
+                    region // self.number_of_slice_regions + x_position
+                ) / self.number_of_slice_regions
+                y_position = (
+                    region % self.number_of_slice_regions + y_position
+                ) / self.number_of_slice_regions
+            x_start = round(x_position * (self.x.size - self.slice_size))
+            y_start = round(y_position * (self.y.size - self.slice_size))
             z, z_above_ground, u, v, w, pressure = slice_only_dim_dicts(
                 z,
                 z_above_ground,
@@ -6,7 +6,7 @@ Apache License
 Entry point for training or testing wind_field_GAN_3D
 Sets up environment/logging, and starts training/testing
 Usage:
-    python run.py < --train | --test | --use > [ --cfg path/to/config.ini ] [ -h ]
+    python run.py < --train | --test | --use | --quantize | --export_onnx | --export_torchscript | --distill | --prune > [ --cfg path/to/config.ini ] [ -h ]
 
 """
 
@@ -24,6 +24,11 @@ from train import train
 from test import test
 from process_data import preprosess
 from param_search import param_search
+from tools.quantization import quantize
+from tools.onnxexport import export_onnx
+from tools.torchscriptexport import export_torchscript
+from tools.distillation import distill
+from tools.pruning import prune
 
 
 def main():
@@ -34,9 +39,14 @@ def main():
         and not cfg.is_use
         and not cfg.is_download
         and not cfg.is_param_search
+        and not cfg.is_quantize
+        and not cfg.is_export_onnx
+        and not cfg.is_export_torchscript
+        and not cfg.is_distill
+        and not cfg.is_prune
     ):
         print(
-            "pass either --test, --download, --use or --train as args, and optionally --cfg path/to/config.ini if coconfig/wind_field_GAN_3D_config_local.ini isn't what you're planning on using."
+            "pass either --test, --download, --use, --quantize, --export_onnx, --export_torchscript, --distill, --prune or --train as args, and optionally --cfg path/to/config.ini if coconfig/wind_field_GAN_3D_config_local.ini isn't what you're planning on using."
         )
         return
 
@@ -47,9 +57,6 @@ def main():
 
     setup_torch(cfg)
 
-    if cfg.is_use:
-        test.test(cfg)
-
     save_config(cfg, cfg.env.this_runs_folder)
 
     setup_logger(cfg)
@@ -105,7 +112,32 @@ def main():
         status_logger.info("run.py: finished training")
         cfg.is_train = False
 
-    if cfg.is_test:
+    if cfg.is_distill:
+        status_logger.info("run.py: starting distillation of a student generator")
+        distill(cfg, dataset_train, dataset_validation, dataset_test, x, y)
+        status_logger.info("run.py: finished distillation")
+
+    if cfg.is_prune:
+        status_logger.info("run.py: starting channel pruning of the generator")
+        prune(cfg, dataset_train, dataset_validation, dataset_test, x, y)
+        status_logger.info("run.py: finished pruning")
+
+    if cfg.is_quantize:
+        status_logger.info("run.py: starting int8 quantization of the generator")
+        quantize(cfg, dataset_validation, dataset_test)
+        status_logger.info("run.py: finished quantization")
+
+    if cfg.is_export_onnx:
+        status_logger.info("run.py: starting ONNX export of the generator")
+        export_onnx(cfg, dataset_validation)
+        status_logger.info("run.py: finished ONNX export")
+
+    if cfg.is_export_torchscript:
+        status_logger.info("run.py: starting frozen TorchScript export of the generator")
+        export_torchscript(cfg, dataset_validation)
+        status_logger.info("run.py: finished TorchScript export")
+
+    if cfg.is_test or cfg.is_use:
         status_logger.info("run.py: starting testing")
         test(cfg, dataset_test)
         status_logger.info("run.py: finished testing")
@@ -154,6 +186,41 @@ def argv_to_cfg() -> Config:
         help="Only downloads data, does not train or test",
     )
 
+    parser.add_argument(
+        "--quantize",
+        default=False,
+        action="store_true",
+        help="quantize the generator at generator_load_path to int8 for CPU inference",
+    )
+
+    parser.add_argument(
+        "--export_onnx",
+        default=False,
+        action="store_true",
+        help="export the generator at generator_load_path to ONNX next to it",
+    )
+
+    parser.add_argument(
+        "--export_torchscript",
+        default=False,
+        action="store_true",
+        help="export the generator at generator_load_path as frozen TorchScript next to it",
+    )
+
+    parser.add_argument(
+        "--distill",
+        default=False,
+        action="store_true",
+        help="train a smaller student generator against the teacher in [DISTILLATION]",
+    )
+
+    parser.add_argument(
+        "--prune",
+        default=False,
+        action="store_true",
+        help="prune channels of the generator at generator_load_path and fine-tune it",
+    )
+
     parser.add_argument(
         "--loglevel",
         default=False,
@@ -174,6 +241,11 @@ def argv_to_cfg() -> Config:
     is_use = args.use
     is_download = args.download
     is_param_search = args.param_search
+    is_quantize = args.quantize
+    is_export_onnx = args.export_onnx
+    is_export_torchscript = args.export_torchscript
+    is_distill = args.distill
+    is_prune = args.prune
     cfg_path = args.cfg
     slurm_array_id = args.slurm_array_id
 
@@ -189,6 +261,11 @@ def argv_to_cfg() -> Config:
     cfg.is_train = is_train
     cfg.is_download = is_download
     cfg.is_param_search = is_param_search
+    cfg.is_quantize = is_quantize
+    cfg.is_export_onnx = is_export_onnx
+    cfg.is_export_torchscript = is_export_torchscript
+    cfg.is_distill = is_distill
+    cfg.is_prune = is_prune
     cfg.slurm_array_id = slurm_array_id
 
     return cfg
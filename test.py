@@ -14,9 +14,22 @@ import pickle as pkl
 import torch.nn as nn
 
 import config.config as config
-from GAN_models.wind_field_GAN_3D import wind_field_GAN_3D, calculate_PSNR
+from GAN_models.wind_field_GAN_3D import (
+    wind_field_GAN_3D,
+    calculate_PSNR,
+    create_generator,
+)
 import iocomponents.displaybar as displaybar
 from download_data import reverse_interpolate_z_axis
+from tools.onnxexport import OnnxGenerator
+from tools.torchscriptexport import load_torchscript_generator
+from tools.tiledinference import (
+    halo_covers_receptive_field,
+    receptive_field_radius,
+    tile_halo,
+    tiled_forward,
+    tiling_error,
+)
 
 
 def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
@@ -36,22 +49,60 @@ def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
     else:
         raise ValueError("Test dataset not supplied")
 
-    if cfg.model.lower() == "wind_field_gan_3d":
-        gan = wind_field_GAN_3D(cfg)
-        status_logger.info(f"Making model wind_field_GAN_3D from config {cfg.name}")
-    else:
+    gan = None
+    if cfg.generator.inference_backend.lower() == "pytorch":
+        if cfg.model.lower() == "wind_field_gan_3d":
+            gan = wind_field_GAN_3D(cfg)
+            status_logger.info(f"Making model wind_field_GAN_3D from config {cfg.name}")
+        else:
+            status_logger.info(
+                f"only wind_field_GAN_2D (wind_field_GAN_2D) and wind_field_GAN_3D(wind_field_gan_3d) is supported at this time - not {cfg.name}"
+            )
+
         status_logger.info(
-            f"only wind_field_GAN_2D (wind_field_GAN_2D) and wind_field_GAN_3D(wind_field_gan_3d) is supported at this time - not {cfg.name}"
+            f"loading model from from saves. G: {cfg.env.generator_load_path}"
         )
-
+        _, __ = gan.load_model(
+            generator_load_path=cfg.env.generator_load_path,
+            discriminator_load_path=None,
+            state_load_path=None,
+        )
+        if cfg.generator.use_terrain_cache:
+            gan.G.enable_terrain_cache(
+                cfg.generator.terrain_cache_tolerance,
+                cfg.generator.terrain_cache_size,
+            )
+            status_logger.info(
+                f"caching the terrain features of {cfg.generator.terrain_cache_size} terrains with tolerance {cfg.generator.terrain_cache_tolerance}"
+            )
+    G, device, receptive_field = load_inference_generator(cfg, gan)
     status_logger.info(
-        f"loading model from from saves. G: {cfg.env.generator_load_path}"
-    )
-    _, __ = gan.load_model(
-        generator_load_path=cfg.env.generator_load_path,
-        discriminator_load_path=None,
-        state_load_path=None,
+        f"running inference with the {cfg.generator.inference_backend} backend on {device}"
     )
+    if receptive_field is None and cfg.dataset_test.tile_size > 0:
+        # tiling exports without it, e.g. int8 generators and older onnx exports, takes it
+        # from an unscripted generator of the config, the weights do not matter
+        receptive_field = receptive_field_radius(
+            create_generator(cfg, script_RDB_convs=False), cfg.scale
+        )
+    if cfg.dataset_test.tile_size > 0:
+        halo = tile_halo(
+            cfg.dataset_test.tile_size, cfg.dataset_test.tile_halo, receptive_field
+        )
+        status_logger.info(
+            f"tiled inference in {cfg.dataset_test.tile_size} x {cfg.dataset_test.tile_size} LR tiles with a halo of {halo} LR pixels"
+        )
+        if not halo_covers_receptive_field(halo, receptive_field):
+            status_logger.warning(
+                f"tiled inference is not exact: the tile halo of {halo} LR pixels does not cover the receptive field radius {receptive_field}, which needs a tile_halo of {2 * receptive_field} and a tile_size of at least {8 * receptive_field}. Set report_tiling_error to log the error per field"
+            )
+
+    use_mc_dropout = cfg.dataset_test.mc_dropout_samples > 0
+    if use_mc_dropout:
+        G = mc_dropout_generator(cfg, gan)
+        status_logger.info(
+            f"saving the mean and standard deviation of {cfg.dataset_test.mc_dropout_samples} Monte Carlo dropout samples"
+        )
 
     if reverse_interpolate == False:
         cfg.gan_config.interpolate_z = False
@@ -106,18 +157,40 @@ def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
     if cfg.is_use:
         for j, (LR, HR, Z, filenames, _, _) in enumerate(dataloader_test):
             status_logger.info(f"batch {j}")
+            interpolated_LR = nn.functional.interpolate(
+                LR[:, :3, :, :, :],
+                scale_factor=(cfg.scale, cfg.scale, 1),
+                align_corners=True,
+                mode="trilinear",
+            )
             for i in range(len(LR)):
                 status_logger.info(f"field {i}")
                 indx = torch.tensor([i])
                 LR_i = torch.index_select(LR, 0, indx, out=None)
-                SR_i = gan.G(LR_i.to(cfg.device, non_blocking=True)).cpu()
-                write_fields(
+                SR_i = super_resolve(
+                    cfg,
+                    G,
+                    device,
+                    receptive_field,
                     LR_i,
-                    None,
-                    SR_i,
-                    cfg.env.this_runs_folder + "/fields/",
+                    torch.index_select(Z, 0, indx, out=None),
+                    filenames[i],
+                )
+                SR_std_i = None
+                if use_mc_dropout:
+                    SR_i, SR_std_i = SR_i.chunk(2, dim=1)
+                write_fields(
+                    LR[i],
+                    HR[i],
+                    SR_i[0],
+                    interpolated_LR[i],
+                    Z[i],
+                    cfg.env.this_runs_folder,
                     filenames[i],
-                    cfg.scale,
+                    torch.tensor([]),
+                    torch.tensor([]),
+                    torch.tensor([]),
+                    SR_std_i,
                 )
 
     if cfg.is_test:
@@ -149,13 +222,18 @@ def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
                     )
                     HR_i = torch.index_select(HR, 0, torch.as_tensor([i]), out=None)
 
-                    with torch.no_grad():
-                        SR_i = gan.G(
-                            LR_i.to(cfg.device, non_blocking=True),
-                            torch.index_select(Z, 0, torch.as_tensor([i]), out=None).to(
-                                cfg.device, non_blocking=True
-                            ),
-                        ).cpu()
+                    SR_i = super_resolve(
+                        cfg,
+                        G,
+                        device,
+                        receptive_field,
+                        LR_i,
+                        torch.index_select(Z, 0, torch.as_tensor([i]), out=None),
+                        filenames[i],
+                    )
+                    SR_std_i = None
+                    if use_mc_dropout:
+                        SR_i, SR_std_i = SR_i.chunk(2, dim=1)
 
                     if cfg.gan_config.interpolate_z:
                         reverse_SR_i = reverse_interpolate_z_axis(
@@ -259,6 +337,7 @@ def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
                             torch.tensor(
                                 []
                             ),  # reverse_SR_i[0] if cfg.gan_config.interpolate_z else torch.tensor([]),
+                            SR_std_i,
                         )
         with open("./test_output/averages.csv", "a") as f:
             f.write(
@@ -302,6 +381,95 @@ def test(cfg: config.Config, dataset_test, reverse_interpolate=False):
             )
 
 
+def load_inference_generator(cfg: config.Config, gan: wind_field_GAN_3D):
+    """
+    Returns the generator selected by generator.inference_backend, the device it runs on,
+    and its receptive field radius, None if it has to be computed from the config, e.g. for
+    exports without it in their metadata. Only the pytorch backend uses gan.
+    """
+    backend = cfg.generator.inference_backend.lower()
+    if backend == "pytorch":
+        return gan.generate, cfg.device, receptive_field_radius(gan.G, cfg.scale)
+    if backend == "torchscript":
+        return load_torchscript_generator(cfg.env.exported_generator_path, cfg.device)
+    if backend == "onnx":
+        G = OnnxGenerator(cfg.env.exported_generator_path)
+        if G.scale is not None and G.scale != cfg.scale:
+            raise ValueError(
+                f"the onnx generator {cfg.env.exported_generator_path} upscales by {G.scale}, not by the scale {cfg.scale} of the config"
+            )
+        return G, torch.device("cpu"), G.receptive_field
+    raise NotImplementedError(f"Unknown inference backend {backend}")
+
+
+def mc_dropout_generator(cfg: config.Config, gan: wind_field_GAN_3D):
+    """
+    Called like G, but returns the mean and standard deviation of dataset_test.mc_dropout_samples
+    Monte Carlo dropout samples concatenated along the channels, so tiling blends both
+    """
+    if gan is None:
+        raise NotImplementedError(
+            f"Monte Carlo dropout needs the pytorch inference backend, not {cfg.generator.inference_backend}"
+        )
+    if not cfg.generator.dropout_probability:
+        logging.getLogger("status").warning(
+            "Monte Carlo dropout with dropout_probability 0, SR_std will be 0"
+        )
+
+    def G(LR: torch.Tensor, Z: torch.Tensor) -> torch.Tensor:
+        return torch.cat(
+            gan.generate_mc_dropout(
+                LR,
+                Z,
+                cfg.dataset_test.mc_dropout_samples,
+                cfg.dataset_test.mc_dropout_samples_per_batch,
+            ),
+            dim=1,
+        )
+
+    return G
+
+
+def super_resolve(
+    cfg: config.Config,
+    G: nn.Module,
+    device: torch.device,
+    receptive_field: int,
+    LR: torch.Tensor,
+    Z: torch.Tensor,
+    field_name,
+) -> torch.Tensor:
+    """
+    Returns G(LR, Z) on the cpu, computed in tiles if dataset_test.tile_size > 0. With
+    dataset_test.report_tiling_error, also logs the difference to whole-domain inference.
+    """
+    with torch.no_grad():
+        if cfg.dataset_test.tile_size <= 0:
+            return G(
+                LR.to(device, non_blocking=True),
+                Z.to(device, non_blocking=True),
+            ).cpu()
+
+        SR = tiled_forward(
+            G,
+            LR,
+            Z,
+            cfg.scale,
+            cfg.dataset_test.tile_size,
+            halo=cfg.dataset_test.tile_halo,
+            tiles_per_batch=cfg.dataset_test.tiles_per_batch,
+            device=device,
+            receptive_field=receptive_field,
+        )
+        if cfg.dataset_test.report_tiling_error:
+            # runs G on the whole domain, which tiling avoids
+            errors = tiling_error(G, LR, Z, SR, device=device)
+            logging.getLogger("status").info(
+                f"tiling error {field_name}: max abs diff {errors['max_abs_diff']}, mean abs diff {errors['mean_abs_diff']}"
+            )
+        return SR
+
+
 def write_fields(
     LR: torch.Tensor,
     HR: torch.Tensor,
@@ -313,6 +481,7 @@ def write_fields(
     rawHR: torch.Tensor([]),
     Z_raw: torch.Tensor([]),
     SR_orig: torch.Tensor([]),
+    SR_std: torch.Tensor = None,
 ) -> dict:
     fields = dict()
     fields["HR"] = HR.squeeze().numpy()
@@ -324,6 +493,8 @@ def write_fields(
         fields["HR_orig"] = rawHR.squeeze().numpy()
         fields["Z_orig"] = Z_raw.squeeze().numpy()
         fields["SR_orig"] = SR_orig.squeeze().numpy()
+    if SR_std is not None:
+        fields["SR_std"] = SR_std.squeeze().numpy()
 
     with open(
         folder_path + "/fields/test_fields_" + str(field_name) + ".pkl", "wb"
@@ -0,0 +1,82 @@
+"""
+compilation.py
+Apache License
+
+torch.compile with a fallback to eager execution, for the generator, discriminator
+and loss computations of wind_field_GAN_3D
+"""
+
+import logging
+import time
+
+import torch
+
+
+def input_signature(fn, args, kwargs: dict = None) -> tuple:
+    """
+    Shapes, dtypes and devices of the tensors in args and kwargs, the values of the other
+    arguments, e.g. a reduction mode, and the train/eval mode if fn is a module
+    """
+
+    kwargs = kwargs or {}
+
+    def signature(arg):
+        return (
+            (tuple(arg.shape), arg.dtype, arg.device) if torch.is_tensor(arg) else arg
+        )
+
+    return (
+        (getattr(fn, "training", None),)
+        + tuple(signature(arg) for arg in args)
+        + tuple((key, signature(kwargs[key])) for key in sorted(kwargs))
+    )
+
+
+class CompiledWithFallback:
+    """
+    Calls fn through torch.compile(fn, dynamic=False), so a graph is compiled and cached
+    for every input shape (and train/eval mode of modules), and logs the compile time of every new input signature.
+    If torch.compile is unavailable or a compiled call fails, logs a warning and calls
+    fn eagerly from then on. Errors raised while compiling the backward pass, which
+    happens lazily during the first backward, are not caught.
+    """
+
+    def __init__(self, fn, name: str, mode: str = "default"):
+        self.fn = fn
+        self.name = name
+        self.compiled = None
+        self.compile_times = {}
+        try:
+            self.compiled = torch.compile(fn, mode=mode, dynamic=False)
+        except Exception as e:
+            self.fall_back(e)
+
+    def fall_back(self, error: Exception):
+        self.compiled = None
+        logging.getLogger("status").warning(
+            f"compilation: could not compile {self.name}, running it eagerly: {error}"
+        )
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.fn(*args, **kwargs)
+
+        signature = input_signature(self.fn, args, kwargs)
+        try:
+            if signature in self.compile_times:
+                return self.compiled(*args, **kwargs)
+            start = time.perf_counter()
+            output = self.compiled(*args, **kwargs)
+            self.compile_times[signature] = time.perf_counter() - start
+            logging.getLogger("status").info(
+                f"compilation: compiled {self.name} for inputs {signature} in {self.compile_times[signature]:.1f} s"
+            )
+            return output
+        except Exception as e:
+            self.fall_back(e)
+            return self.fn(*args, **kwargs)
+
+
+def compile_with_fallback(fn, name: str, enabled: bool, mode: str = "default"):
+    """fn wrapped in CompiledWithFallback if enabled, otherwise fn itself"""
+    return CompiledWithFallback(fn, name, mode) if enabled else fn
@@ -0,0 +1,109 @@
+"""
+dataloading.py
+Apache License
+
+Implements helpers that reduce the per-iteration cost of moving batches to the device.
+"""
+
+import torch
+
+
+class PinnedBatchRing:
+    """
+    PinnedBatchRing keeps a ring of preallocated, pinned batch buffers for dataloaders
+    without worker processes. collate() stacks the samples straight into the next buffer,
+    replacing both the default collate and the pin_memory copy. With worker processes
+    the batches are collated in the workers, and copying them into a buffer would only
+    move the pin_memory copy onto the training thread, so the ring is not used there.
+    A buffer is only reused after the device copy from it has finished.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        ring_size: int = 3,
+        pin_memory: bool = torch.cuda.is_available(),
+    ):
+        self.batch_size = batch_size
+        self.ring_size = ring_size
+        self.pin_memory = pin_memory
+        self.buffers = [None] * ring_size
+        self.events = [None] * ring_size
+        self.current = ring_size - 1
+
+    def next_buffers(self, sample_shapes: list, dtypes: list) -> tuple:
+        self.current = (self.current + 1) % self.ring_size
+        if self.events[self.current] is not None:
+            self.events[self.current].synchronize()
+            self.events[self.current] = None
+
+        buffers = self.buffers[self.current]
+        if (
+            buffers is None
+            or buffers[0].shape[0] < self.batch_size
+            or [buffer.shape[1:] for buffer in buffers] != sample_shapes
+            or [buffer.dtype for buffer in buffers] != dtypes
+        ):
+            # (re)allocated when the batch size or sample size changes, e.g. by a curriculum
+            buffers = tuple(
+                torch.empty(
+                    (self.batch_size, *shape), dtype=dtype, pin_memory=self.pin_memory
+                )
+                for shape, dtype in zip(sample_shapes, dtypes)
+            )
+            self.buffers[self.current] = buffers
+        return buffers
+
+    def collate(self, samples: list) -> tuple:
+        buffers = self.next_buffers(
+            [tensor.shape for tensor in samples[0]],
+            [tensor.dtype for tensor in samples[0]],
+        )
+        return tuple(
+            torch.stack([sample[i] for sample in samples], out=buffer[: len(samples)])
+            for i, buffer in enumerate(buffers)
+        )
+
+    def to_device(self, batch: tuple, device: torch.device) -> tuple:
+        batch = tuple(tensor.to(device, non_blocking=True) for tensor in batch)
+        if device.type == "cuda":
+            event = torch.cuda.Event()
+            event.record()
+            self.events[self.current] = event
+        return batch
+
+
+class CachedValidationSet:
+    """
+    CachedValidationSet materializes the batches of a validation dataloader once and
+    iterates over them on later validations, without any file I/O.
+    Batches are stored on the device until memory_budget_MB is used, and the rest
+    in (pinned) host memory. Only valid if the dataset returns the same tensors
+    every time, i.e. without data augmentation and without enable_slicing, which
+    draws a random crop of every sample.
+    """
+
+    def __init__(
+        self,
+        dataloader: torch.utils.data.DataLoader,
+        device: torch.device,
+        memory_budget_MB: int = 1024,
+    ):
+        self.batches = []
+        self.number_of_device_batches = 0
+        budget = memory_budget_MB * 2**20
+        for batch in dataloader:
+            nbytes = sum(tensor.numel() * tensor.element_size() for tensor in batch)
+            if device.type != "cpu" and nbytes <= budget:
+                batch = tuple(tensor.to(device) for tensor in batch)
+                budget -= nbytes
+                self.number_of_device_batches += 1
+            elif device.type == "cuda" and not batch[0].is_pinned():
+                batch = tuple(tensor.pin_memory() for tensor in batch)
+            self.batches.append(batch)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
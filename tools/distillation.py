@@ -0,0 +1,225 @@
+"""
+distillation.py
+Apache License
+
+Implements knowledge distillation of a frozen teacher Generator_3D, e.g. one of the
+pretrained_models, into a smaller student generator. The student is trained with the
+pixel and physics losses of wind_field_GAN_3D against HR, a feature matching loss
+between its trunk features and the teacher's, and optionally a pixel loss against the
+teacher's SR. Nothing adversarial is involved, so no discriminator is trained.
+"""
+
+import logging
+import os
+from configparser import ConfigParser
+
+import torch
+import torch.nn as nn
+
+import config.config as config
+import tools.initialization as initialization
+from CNN_models.Generator_3D_Resnet_ESRGAN import Generator_3D
+from GAN_models.wind_field_GAN_3D import (
+    create_generator,
+    generator_arguments,
+    physics_losses,
+)
+from tools.generatorcomparison import compare_generators
+from train import create_train_dataloader
+
+PIXEL_LOSSES = {"l1": nn.functional.l1_loss, "l2": nn.functional.mse_loss}
+
+
+def load_teacher(cfg: config.Config, device: torch.device) -> Generator_3D:
+    """
+    Builds the frozen teacher from the [GENERATOR] and [GAN] sections of
+    distillation.teacher_config_path. The sections are read into new config instances,
+    since reading a second Config would overwrite the shared sub-configs of cfg.
+    """
+    cfg_d: config.DistillationConfig = cfg.distillation
+    parser = ConfigParser(allow_no_value=True)
+    if not parser.read(cfg_d.teacher_config_path):
+        raise FileNotFoundError(
+            f"teacher config {cfg_d.teacher_config_path} could not be read"
+        )
+    teacher_cfg_G = config.GeneratorConfig()
+    teacher_cfg_G.setGeneratorConfig(parser["GENERATOR"])
+    teacher_cfg_gan = config.GANConfig()
+    teacher_cfg_gan.setGANConfig(parser["GAN"])
+    teacher_arguments = generator_arguments(
+        teacher_cfg_G, teacher_cfg_gan, parser["DEFAULT"].getint("scale")
+    )
+
+    student_arguments = generator_arguments(cfg.generator, cfg.gan_config, cfg.scale)
+    for argument in ("in_channels", "out_channels", "upscale", "number_of_z_layers"):
+        if teacher_arguments[argument] != student_arguments[argument]:
+            raise ValueError(
+                f"teacher {argument} {teacher_arguments[argument]} does not match {student_arguments[argument]} of this config"
+            )
+
+    teacher = Generator_3D(**teacher_arguments, device=device)
+    generator_path = cfg_d.teacher_generator_path or parser["ENV"].get(
+        "generator_load_path"
+    )
+    teacher.load_state_dict(torch.load(generator_path, map_location="cpu"))
+    teacher.to(device).eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    return teacher
+
+
+def distillation_losses(
+    cfg: config.Config,
+    student: Generator_3D,
+    adapter: nn.Module,
+    teacher: Generator_3D,
+    LR: torch.Tensor,
+    HR: torch.Tensor,
+    Z: torch.Tensor,
+    x: torch.Tensor,
+    y: torch.Tensor,
+) -> dict:
+    """Weighted losses of the student on a batch, and their sum as total"""
+    cfg_t: config.TrainingConfig = cfg.training
+    cfg_d: config.DistillationConfig = cfg.distillation
+    pixel_loss = PIXEL_LOSSES.get(cfg_t.pixel_criterion)
+
+    SR, trunk = student.forward_with_trunk(LR, Z)
+    with torch.no_grad():
+        teacher_SR, teacher_trunk = teacher.forward_with_trunk(LR, Z)
+
+    losses = {
+        "pix": torch.zeros(1, device=LR.device),
+        "feature": nn.functional.mse_loss(adapter(trunk), teacher_trunk)
+        * cfg_d.feature_loss_weight,
+    }
+    if pixel_loss is not None:
+        losses["pix"] = pixel_loss(SR, HR) * cfg_t.pixel_loss_weight
+        if cfg_d.teacher_pixel_loss_weight > 0:
+            losses["teacher_pix"] = (
+                pixel_loss(SR, teacher_SR) * cfg_d.teacher_pixel_loss_weight
+            )
+
+    xy_gradient, z_gradient, divergence, xy_divergence = physics_losses(
+        HR, SR, x[: HR.shape[2]], y[: HR.shape[3]], Z
+    )
+    physics = {
+        "xy_gradient": xy_gradient * cfg_t.gradient_xy_loss_weight,
+        "z_gradient": z_gradient * cfg_t.gradient_z_loss_weight,
+        "divergence": divergence * cfg_t.divergence_loss_weight,
+        "xy_divergence": xy_divergence * cfg_t.xy_divergence_loss_weight,
+    }
+    # like wind_field_GAN_3D, the physics losses are left out if any is nan or inf
+    if all(torch.isfinite(loss) for loss in physics.values()):
+        losses.update(physics)
+    losses["total"] = sum(losses.values())
+    return losses
+
+
+def distill(cfg: config.Config, dataset_train, dataset_validation, dataset_test, x, y):
+    """
+    Trains a student generator with distillation.student_num_features features and
+    distillation.student_num_RRDB RRDBs against the teacher, saves it as G_student.pth
+    in the run folder and reports latency, size, PSNR and pix of student and teacher
+    """
+    status_logger = logging.getLogger("status")
+    cfg_t: config.TrainingConfig = cfg.training
+    cfg_d: config.DistillationConfig = cfg.distillation
+    device = cfg.device
+
+    teacher = load_teacher(cfg, device)
+    student = create_generator(
+        cfg,
+        device=device,
+        number_of_features=cfg_d.student_num_features,
+        number_of_RRDBs=cfg_d.student_num_RRDB,
+    ).to(device)
+    initialization.init_weights(student, scale=cfg.generator.weight_init_scale)
+    # maps the student trunk features to the teacher's number of features
+    adapter = (nn.Conv2d if cfg.gan_config.conv_mode == "2D" else nn.Conv3d)(
+        cfg_d.student_num_features, teacher.number_of_features, kernel_size=1
+    ).to(device)
+    status_logger.info(
+        f"distillation: teacher {sum(p.numel() for p in teacher.parameters())} params, student {sum(p.numel() for p in student.parameters())} params"
+    )
+
+    optimizer = torch.optim.Adam(
+        list(student.parameters()) + list(adapter.parameters()),
+        lr=cfg_t.learning_rate_g,
+        weight_decay=cfg_t.adam_weight_decay_g,
+        betas=(cfg_t.adam_beta1_g, 0.999),
+    )
+    dataloader_train = create_train_dataloader(
+        cfg, dataset_train, cfg.dataset_train.batch_size
+    )
+    dataloader_val = torch.utils.data.DataLoader(
+        dataset_validation,
+        batch_size=cfg.dataset_val.batch_size,
+        shuffle=False,
+        num_workers=cfg.dataset_val.num_workers,
+    )
+    x, y = x.to(device), y.to(device)
+
+    it = 0
+    while it < cfg_d.niter:
+        for LR, HR, Z in dataloader_train:
+            if it >= cfg_d.niter:
+                break
+            it += 1
+            LR = LR.to(device, non_blocking=True)
+            HR = HR.to(device, non_blocking=True)
+            Z = Z.to(device, non_blocking=True)
+
+            student.train()
+            optimizer.zero_grad(set_to_none=True)
+            losses = distillation_losses(
+                cfg, student, adapter, teacher, LR, HR, Z, x, y
+            )
+            losses["total"].backward()
+            optimizer.step()
+
+            if it % cfg_t.log_period == 0:
+                status_logger.info(
+                    f"distillation: it {it} "
+                    + ", ".join(f"{k} {v.item():.4g}" for k, v in losses.items())
+                )
+            if it % cfg_t.val_period == 0:
+                student.eval()
+                validation_loss = 0.0
+                with torch.no_grad():
+                    for LR, HR, Z in dataloader_val:
+                        validation_loss += distillation_losses(
+                            cfg,
+                            student,
+                            adapter,
+                            teacher,
+                            LR.to(device),
+                            HR.to(device),
+                            Z.to(device),
+                            x,
+                            y,
+                        )["total"].item() / len(dataloader_val)
+                status_logger.info(
+                    f"distillation: it {it} validation loss {validation_loss:.4g}"
+                )
+            if it % cfg_t.save_model_period == 0:
+                torch.save(
+                    student.state_dict(),
+                    os.path.join(cfg.env.this_runs_folder, f"G_student_{it}.pth"),
+                )
+
+    save_path = os.path.join(cfg.env.this_runs_folder, "G_student.pth")
+    torch.save(student.state_dict(), save_path)
+    status_logger.info(
+        f"distillation: saved student to {save_path}, load it with [GENERATOR] num_features = {cfg_d.student_num_features} and num_RRDB = {cfg_d.student_num_RRDB}"
+    )
+
+    student.eval()
+    report = compare_generators(
+        {"teacher": teacher, "student": student},
+        dataset_test,
+        cfg_d.report_samples,
+        device=device,
+    )
+    status_logger.info(f"distillation: teacher vs student on the test set\n{report}")
+    print(report)
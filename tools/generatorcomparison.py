@@ -0,0 +1,111 @@
+"""
+generatorcomparison.py
+Apache License
+
+Compares the latency, size and accuracy of generators on the test set, e.g. an exported
+or distilled generator against the float generator it was made from.
+"""
+
+import io
+import time
+
+import torch
+import torch.nn as nn
+from tabulate import tabulate
+
+from CNN_models.torch_blocks import Horizontal_Conv_3D, RDB_Horizontal_Conv_3D
+from GAN_models.wind_field_GAN_3D import calculate_PSNR
+
+
+def serialized_size(module: nn.Module) -> int:
+    buffer = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        torch.jit.save(module, buffer)
+    else:
+        torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+def count_conv_MACs(G: nn.Module, LR: torch.Tensor, Z: torch.Tensor) -> int:
+    """
+    Multiply-accumulates of the convolutions in one forward of G on (LR, Z). Counted with
+    forward hooks, so G must not contain scripted modules, e.g. be built with script_RDB_convs=False.
+    """
+    if any(isinstance(m, torch.jit.ScriptModule) for m in G.modules()):
+        raise ValueError("can not count the MACs of scripted modules")
+
+    MACs = []
+
+    def count(module, input, output):
+        # the level convs of horizontal convs are run at once, with the weights of the first level's shape
+        weight = (
+            module.convs[0][0].weight
+            if isinstance(module, (Horizontal_Conv_3D, RDB_Horizontal_Conv_3D))
+            else module.weight
+        )
+        MACs.append(
+            output.shape[0] * output[0, 0].numel() * weight.shape[0] * weight[0].numel()
+        )
+
+    handles = [
+        module.register_forward_hook(count)
+        for module in G.modules()
+        if isinstance(
+            module,
+            (nn.Conv2d, nn.Conv3d, Horizontal_Conv_3D, RDB_Horizontal_Conv_3D),
+        )
+    ]
+    try:
+        with torch.no_grad():
+            G(LR, Z)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sum(MACs)
+
+
+def compare_generators(
+    generators: dict,
+    dataset_test,
+    number_of_samples: int = 0,
+    device: torch.device = torch.device("cpu"),
+) -> str:
+    """
+    Table of the mean latency, serialized size, PSNR and pix error of each generator in
+    generators, a dict of name: G, over the first number_of_samples test samples (0 for all)
+    """
+    if number_of_samples <= 0:
+        number_of_samples = len(dataset_test)
+    number_of_samples = min(number_of_samples, len(dataset_test))
+    UVW_MAX = dataset_test.UVW_MAX
+
+    rows = []
+    for name, G in generators.items():
+        latency, PSNR, pix = 0.0, 0.0, 0.0
+        with torch.no_grad():
+            LR, _, Z = dataset_test[0][:3]
+            G(LR.unsqueeze(0).to(device), Z.unsqueeze(0).to(device))  # warmup
+            for i in range(number_of_samples):
+                LR, HR, Z = dataset_test[i][:3]
+                LR, Z = LR.unsqueeze(0).to(device), Z.unsqueeze(0).to(device)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                SR = G(LR, Z)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                latency += (time.perf_counter() - start) / number_of_samples
+                SR, HR = SR.cpu(), HR.unsqueeze(0)[:, :3]
+                PSNR += calculate_PSNR(HR, SR).item() / number_of_samples
+                pix += (
+                    torch.mean(torch.linalg.vector_norm(HR - SR, dim=1)).item()
+                    * UVW_MAX
+                    / number_of_samples
+                )
+        rows.append([name, latency, serialized_size(G) / 2**20, PSNR, pix])
+
+    return tabulate(
+        rows,
+        headers=["generator", "latency [s]", "size [MB]", "PSNR", "pix [m/s]"],
+        floatfmt=".4g",
+    )
@@ -0,0 +1,138 @@
+"""
+onnxexport.py
+Apache License
+
+Exports Generator_3D to ONNX with dynamic batch and horizontal sizes, and runs exported
+generators on ONNX Runtime's CPU provider, which test.py uses with inference_backend = onnx.
+The export stores the receptive field radius and scale of the generator in the model metadata,
+so test.py builds no torch generator for tiling. torch and the models are only imported by
+export_onnx and OnnxGenerator.__call__, so OnnxGenerator.run works without torch installed;
+test.py itself still loads and scores the data with torch.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+import config.config as config
+
+ONNX_OPSET = 17
+# metadata_props of the exported model
+RECEPTIVE_FIELD_KEY = "receptive_field"
+SCALE_KEY = "scale"
+
+
+class OnnxGenerator:
+    """
+    Called like Generator_3D, G(LR, Z) -> SR, but runs an exported generator with ONNX Runtime
+    on the cpu. run() takes and returns numpy arrays, so it is usable without torch.
+    __call__ takes and returns torch tensors. receptive_field and scale are read from the
+    model metadata, None for models exported without it.
+    """
+
+    def __init__(self, path: str, optimize_graph: bool = True):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if optimize_graph
+            else onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.receptive_field = (
+            int(metadata[RECEPTIVE_FIELD_KEY])
+            if RECEPTIVE_FIELD_KEY in metadata
+            else None
+        )
+        self.scale = int(metadata[SCALE_KEY]) if SCALE_KEY in metadata else None
+
+    def run(self, LR: np.ndarray, Z: np.ndarray) -> np.ndarray:
+        (SR,) = self.session.run(
+            ["SR"],
+            {"LR": LR.astype(np.float32), "Z": Z.astype(np.float32)},
+        )
+        return SR
+
+    def __call__(self, LR, Z):
+        import torch
+
+        return torch.from_numpy(
+            self.run(LR.detach().cpu().numpy(), Z.detach().cpu().numpy())
+        )
+
+    def eval(self):
+        return self
+
+
+def onnx_path(cfg: config.Config) -> str:
+    """generator_load_path with the .onnx extension, next to the weights and their config"""
+    return os.path.splitext(cfg.env.generator_load_path)[0] + ".onnx"
+
+
+def export_onnx(cfg: config.Config, dataset_validation, tolerance: float = 1e-4) -> str:
+    """
+    Exports the generator at cfg.env.generator_load_path to ONNX, and checks ONNX Runtime
+    against PyTorch on a validation sample and on a horizontally cropped copy of it, to
+    verify the dynamic x/y sizes. Returns the path of the exported model.
+    """
+    import onnx
+    import torch
+
+    from GAN_models.wind_field_GAN_3D import create_generator
+    from tools.tiledinference import receptive_field_radius
+
+    status_logger = logging.getLogger("status")
+    G = create_generator(cfg, script_RDB_convs=False, dense_block_mode="concat")
+    G.load_state_dict(torch.load(cfg.env.generator_load_path, map_location="cpu"))
+    G.eval()
+
+    LR, _, Z = dataset_validation[0][:3]
+    LR, Z = LR.unsqueeze(0), Z.unsqueeze(0)
+    path = onnx_path(cfg)
+    torch.onnx.export(
+        G,
+        (LR, Z),
+        path,
+        input_names=["LR", "Z"],
+        output_names=["SR"],
+        dynamic_axes={
+            "LR": {0: "batch", 2: "x", 3: "y"},
+            "Z": {0: "batch", 2: "HR_x", 3: "HR_y"},
+            "SR": {0: "batch", 2: "HR_x", 3: "HR_y"},
+        },
+        opset_version=ONNX_OPSET,
+    )
+    model = onnx.load(path)
+    onnx.helper.set_model_props(
+        model,
+        {
+            RECEPTIVE_FIELD_KEY: str(receptive_field_radius(G, cfg.scale)),
+            SCALE_KEY: str(cfg.scale),
+        },
+    )
+    onnx.save(model, path)
+    status_logger.info(f"onnx: exported generator to {path}")
+
+    G_onnx = OnnxGenerator(path)
+    cropped_size = max(LR.shape[2] // 2, 1), max(LR.shape[3] // 2, 1)
+    checks = {
+        f"{LR.shape[2]}x{LR.shape[3]}": (LR, Z),
+        f"{cropped_size[0]}x{cropped_size[1]}": (
+            LR[:, :, : cropped_size[0], : cropped_size[1]],
+            Z[:, :, : cropped_size[0] * cfg.scale, : cropped_size[1] * cfg.scale],
+        ),
+    }
+    with torch.no_grad():
+        for size, (LR_check, Z_check) in checks.items():
+            max_diff = (G(LR_check, Z_check) - G_onnx(LR_check, Z_check)).abs().max()
+            message = f"onnx: max abs diff to pytorch on a {size} LR input: {max_diff.item():.3g}"
+            if max_diff > tolerance:
+                status_logger.warning(f"{message}, above the tolerance {tolerance}")
+            else:
+                status_logger.info(message)
+    return path
@@ -0,0 +1,377 @@
+"""
+pruning.py
+Apache License
+
+Implements structured channel pruning of Generator_3D. The channels of the trunk features,
+the upsampler and hr conv features, and the growth channels of every RDB conv are ranked by
+the L1 norm of their filters or by their mean absolute activation on validation samples.
+The least important channels are removed, which gives a smaller dense Generator_3D with fewer
+num_features and RDB_growth_chan, that is then fine-tuned with wind_field_GAN_3D.
+"""
+
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+import config.config as config
+from CNN_models.Generator_3D_Resnet_ESRGAN import Generator_3D
+from CNN_models.torch_blocks import (
+    Horizontal_Conv_3D,
+    PixelShuffle_xy,
+    RDB_Conv,
+    RDB_Horizontal_Conv_3D,
+)
+from GAN_models.wind_field_GAN_3D import (
+    create_generator,
+    generator_arguments,
+    wind_field_GAN_3D,
+)
+from tools.generatorcomparison import compare_generators, count_conv_MACs
+from train import create_train_dataloader
+
+
+def conv_layers(unit: nn.Module) -> list:
+    """
+    The convs of a conv unit of Generator_3D: a conv, an RDB conv, a horizontal conv with one
+    conv per level, or a create_conv_lrelu_layer Sequential
+    """
+    if isinstance(unit, (nn.Conv2d, nn.Conv3d)):
+        return [unit]
+    if isinstance(unit, RDB_Conv):
+        return [unit.conv[0]]
+    if isinstance(unit, (Horizontal_Conv_3D, RDB_Horizontal_Conv_3D)):
+        return [level[0] for level in unit.convs]
+    return [unit[0]]
+
+
+def upsampler_conv(block: nn.Sequential) -> tuple:
+    """The conv unit of a create_UpConv_block, and its number of output channels per feature"""
+    if isinstance(block[1], (nn.PixelShuffle, PixelShuffle_xy)):
+        return block[0], block[1].upscale_factor ** 2
+    return block[1], 1
+
+
+def named_RDBs(G: Generator_3D) -> list:
+    """(name, RDB) of every RDB in the RRDBs of G"""
+    RRDBs = list(G.model[1].module)[:-1]
+    return [
+        (f"RRDB{r}.RDB{b}", RDB)
+        for r, RRDB in enumerate(RRDBs)
+        for b, RDB in enumerate(RRDB.RDBs)
+    ]
+
+
+def channel_layout(G: Generator_3D) -> list:
+    """
+    (unit, (output space, output channels per channel), input spaces) of every pruned conv unit of G.
+    A space is a set of channels that is pruned as one: trunk, the features from feature_conv
+    through the RRDBs and their shortcut, upsampler{u}, hr and the growth channels RRDB{r}.RDB{b}.conv{i}.
+    Input spaces are (space, channels) in the order of the input channels, with space None
+    for channels that are not pruned. The output space of the last hr conv is None.
+    """
+    number_of_features = G.number_of_features
+    layout = [
+        (G.model[0], ("trunk", 1), [(None, conv_layers(G.model[0])[0].in_channels)])
+    ]
+    for name, RDB in named_RDBs(G):
+        inputs = [("trunk", number_of_features)]
+        for i in range(len(RDB._modules) - 1):
+            conv = getattr(RDB, f"conv{i}")
+            space = f"{name}.conv{i}"
+            layout.append((conv, (space, 1), list(inputs)))
+            inputs.append((space, conv_layers(conv)[0].out_channels))
+        layout.append((RDB.LFF, ("trunk", 1), inputs))
+    layout.append(
+        (G.model[1].module[-1], ("trunk", 1), [("trunk", number_of_features)])
+    )
+
+    previous = "trunk"
+    for u, block in enumerate(G.model[2:]):
+        conv, channels_per_feature = upsampler_conv(block)
+        layout.append(
+            (
+                conv,
+                (f"upsampler{u}", channels_per_feature),
+                [(previous, number_of_features)],
+            )
+        )
+        previous = f"upsampler{u}"
+
+    terrain_features = conv_layers(G.terrain_convs[-1])[0].out_channels
+    layout.append(
+        (
+            G.hr_convs[0],
+            ("hr", 1),
+            [(previous, number_of_features), (None, terrain_features)],
+        )
+    )
+    layout.append(
+        (G.hr_convs[-1], (None, 1), [("hr", number_of_features + terrain_features)])
+    )
+    return layout
+
+
+def space_sizes(layout: list) -> dict:
+    sizes = {}
+    for unit, (space, channels_per_feature), _ in layout:
+        if space is not None:
+            sizes[space] = conv_layers(unit)[0].out_channels // channels_per_feature
+    return sizes
+
+
+def weight_norm_importance(layout: list) -> dict:
+    """
+    Importance of every channel of every space: the L1 norm of the filters producing it,
+    summed over the units writing to the space after dividing by the mean of each unit
+    """
+    importance = {}
+    for unit, (space, channels_per_feature), _ in layout:
+        if space is None:
+            continue
+        norms = sum(
+            conv.weight.detach().abs().flatten(1).sum(1) for conv in conv_layers(unit)
+        )
+        norms = norms.view(-1, channels_per_feature).sum(1)
+        importance[space] = importance.get(space, 0) + norms / norms.mean().clamp_min(
+            1e-12
+        )
+    return importance
+
+
+def activation_importance(
+    G: Generator_3D, sizes: dict, calibration_batches: list
+) -> dict:
+    """
+    Importance of every channel of every space: the mean absolute activation of the channel
+    on calibration_batches, a list of (LR, Z), summed over the places the space is measured
+    after dividing by the mean of each place. The trunk is measured after feature_conv,
+    after every RDB and after the RRDB shortcut.
+    """
+    places = [(G.model[0], "trunk"), (G.model[1], "trunk")]
+    for name, RDB in named_RDBs(G):
+        places.append((RDB, "trunk"))
+        # RDB convs output their input followed by the growth channels
+        places += [
+            (getattr(RDB, f"conv{i}"), f"{name}.conv{i}")
+            for i in range(len(RDB._modules) - 1)
+        ]
+    places += [(block, f"upsampler{u}") for u, block in enumerate(G.model[2:])]
+    places.append((G.hr_convs[0], "hr"))
+
+    activations = [0.0] * len(places)
+
+    def record(index: int, space: str):
+        def hook(module, input, output):
+            channels = output[:, output.shape[1] - sizes[space] :]
+            activations[index] = activations[index] + channels.abs().transpose(
+                0, 1
+            ).flatten(1).mean(1)
+
+        return hook
+
+    handles = [
+        module.register_forward_hook(record(index, space))
+        for index, (module, space) in enumerate(places)
+    ]
+    try:
+        with torch.no_grad():
+            for LR, Z in calibration_batches:
+                G(LR, Z)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    importance = {}
+    for (_, space), activation in zip(places, activations):
+        importance[space] = importance.get(
+            space, 0
+        ) + activation / activation.mean().clamp_min(1e-12)
+    return importance
+
+
+def pruned_state_dict(G: Generator_3D, layout: list, keep: dict) -> dict:
+    """State dict of G with only the channels in keep, a dict of space: kept channel indices"""
+    names = {module: name for name, module in G.named_modules()}
+    state = G.state_dict()
+    for unit, (space, channels_per_feature), inputs in layout:
+        out_index = None
+        if space is not None:
+            out_index = (
+                keep[space][:, None] * channels_per_feature
+                + torch.arange(channels_per_feature)
+            ).flatten()
+        in_index, offset = [], 0
+        for input_space, channels in inputs:
+            in_index.append(
+                offset
+                + (
+                    keep[input_space]
+                    if input_space is not None
+                    else torch.arange(channels)
+                )
+            )
+            offset += channels
+        in_index = torch.cat(in_index)
+
+        for conv in conv_layers(unit):
+            name = names[conv]
+            weight = state[f"{name}.weight"]
+            if out_index is not None:
+                weight = weight[out_index]
+                if conv.bias is not None:
+                    state[f"{name}.bias"] = state[f"{name}.bias"][out_index]
+            state[f"{name}.weight"] = weight[:, in_index]
+    return state
+
+
+def finetune(cfg: config.Config, G_pruned: Generator_3D, dataset_train, x, y):
+    """
+    Fine-tunes G_pruned for pruning.finetune_niter iterations with
+    wind_field_GAN_3D.optimize_parameters and the [TRAINING] losses. cfg.generator must
+    describe G_pruned. Returns the fine-tuned generator of the GAN.
+    """
+    status_logger = logging.getLogger("status")
+    cfg_t: config.TrainingConfig = cfg.training
+    niter = cfg.pruning.finetune_niter
+
+    is_train = cfg.is_train
+    cfg.is_train = True
+    gan = wind_field_GAN_3D(cfg)
+    cfg.is_train = is_train
+    gan.G.load_state_dict(G_pruned.state_dict())
+    if gan.D is None:
+        status_logger.info("pruning: fine-tuning without a discriminator")
+    elif cfg.env.discriminator_load_path and os.path.isfile(
+        cfg.env.discriminator_load_path
+    ):
+        gan.load_model(discriminator_load_path=cfg.env.discriminator_load_path)
+    else:
+        status_logger.info("pruning: fine-tuning with a new discriminator")
+
+    dataloader_train = create_train_dataloader(
+        cfg, dataset_train, cfg.dataset_train.batch_size
+    )
+    gan.feed_xy_niter(
+        x.to(cfg.device),
+        y.to(cfg.device),
+        torch.tensor(niter, device=cfg.device),
+        cfg_t.d_g_train_ratio,
+        cfg_t.d_g_train_period,
+    )
+
+    it = 0
+    while it < niter:
+        for LR, HR, Z in dataloader_train:
+            if it >= niter:
+                break
+            it += 1
+            gan.optimize_parameters(
+                LR.to(cfg.device, non_blocking=True),
+                HR.to(cfg.device, non_blocking=True),
+                Z.to(cfg.device, non_blocking=True),
+                it,
+            )
+            gan.update_learning_rate() if it > 2 * cfg_t.d_g_train_period else None
+            if it % cfg_t.log_period == 0 and gan.is_G_iteration(it):
+                status_logger.info(
+                    f"pruning: fine-tuning it {it} "
+                    + ", ".join(
+                        f"{k} {v.item():.4g}"
+                        for k, v in gan.get_G_train_loss_dict_ref().items()
+                    )
+                )
+    return gan.G.eval()
+
+
+def prune(cfg: config.Config, dataset_train, dataset_validation, dataset_test, x, y):
+    """
+    Prunes the generator at cfg.env.generator_load_path, fine-tunes it, saves it as G_pruned.pth
+    with its config G_pruned_config.ini in the run folder, and reports MACs, latency, size,
+    PSNR and pix of the original and pruned generators. cfg is updated to describe the
+    pruned generator, so a following test uses it.
+    """
+    status_logger = logging.getLogger("status")
+    cfg_p: config.PruningConfig = cfg.pruning
+    device = cfg.device
+    if cfg.gan_config.conv_mode not in {"3D", "horizontal_3D"}:
+        raise NotImplementedError(
+            f"channel pruning is only implemented for conv_mode 3D and horizontal_3D, not {cfg.gan_config.conv_mode}"
+        )
+
+    G = create_generator(
+        cfg, device=device, script_RDB_convs=False, dense_block_mode="concat"
+    )
+    G.load_state_dict(torch.load(cfg.env.generator_load_path, map_location="cpu"))
+    G.to(device).eval()
+
+    layout = channel_layout(G)
+    sizes = space_sizes(layout)
+    if cfg_p.criterion == "weight_norm":
+        importance = weight_norm_importance(layout)
+    elif cfg_p.criterion == "activation":
+        calibration_batches = []
+        for i in range(min(cfg_p.calibration_samples, len(dataset_validation))):
+            LR, _, Z = dataset_validation[i][:3]
+            calibration_batches.append(
+                (LR.unsqueeze(0).to(device), Z.unsqueeze(0).to(device))
+            )
+        importance = activation_importance(G, sizes, calibration_batches)
+    else:
+        raise NotImplementedError(f"Unknown pruning criterion {cfg_p.criterion}")
+
+    cfg_G: config.GeneratorConfig = cfg.generator
+    number_of_features = max(1, round(cfg_G.num_features * cfg_p.feature_keep_ratio))
+    growth_channels = max(1, round(cfg_G.RDB_growth_chan * cfg_p.growth_keep_ratio))
+    keep = {}
+    for space, size in sizes.items():
+        if space == "trunk" or space.startswith("upsampler"):
+            number_to_keep = number_of_features
+        elif space == "hr":
+            number_to_keep = number_of_features + size - cfg_G.num_features
+        else:
+            number_to_keep = growth_channels
+        keep[space] = importance[space].topk(number_to_keep).indices.sort().values.cpu()
+
+    arguments = generator_arguments(cfg_G, cfg.gan_config, cfg.scale)
+    arguments.update(
+        number_of_features=number_of_features,
+        RDB_gc=growth_channels,
+        device=device,
+        script_RDB_convs=False,
+        dense_block_mode="concat",
+    )
+    G_pruned = Generator_3D(**arguments)
+    G_pruned.load_state_dict(pruned_state_dict(G, layout, keep))
+    G_pruned.to(device).eval()
+
+    LR, _, Z = dataset_validation[0][:3]
+    LR, Z = LR.unsqueeze(0).to(device), Z.unsqueeze(0).to(device)
+    MACs, pruned_MACs = count_conv_MACs(G, LR, Z), count_conv_MACs(G_pruned, LR, Z)
+    status_logger.info(
+        f"pruning: num_features {cfg_G.num_features} -> {number_of_features}, RDB_growth_chan {cfg_G.RDB_growth_chan} -> {growth_channels} by {cfg_p.criterion}, "
+        f"{MACs / 1e9:.4g} -> {pruned_MACs / 1e9:.4g} GMACs per validation sample ({MACs / pruned_MACs:.2f}x fewer)"
+    )
+
+    cfg_G.num_features = number_of_features
+    cfg_G.RDB_growth_chan = growth_channels
+    generators = {"original": G, "pruned": G_pruned}
+    if cfg_p.finetune_niter > 0:
+        generators["pruned, fine-tuned"] = finetune(cfg, G_pruned, dataset_train, x, y)
+
+    save_path = os.path.join(cfg.env.this_runs_folder, "G_pruned.pth")
+    torch.save(list(generators.values())[-1].state_dict(), save_path)
+    cfg.env.generator_load_path = save_path
+    config_path = os.path.join(cfg.env.this_runs_folder, "G_pruned_config.ini")
+    with open(config_path, "w") as ini:
+        ini.write(cfg.asINI())
+    status_logger.info(
+        f"pruning: saved pruned generator to {save_path} and its config to {config_path}"
+    )
+
+    report = compare_generators(
+        generators, dataset_test, cfg_p.report_samples, device=device
+    )
+    status_logger.info(f"pruning: original vs pruned on the test set\n{report}")
+    print(report)
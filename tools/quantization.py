@@ -0,0 +1,93 @@
+"""
+quantization.py
+Apache License
+
+Implements post-training static int8 quantization of Generator_3D for CPU inference.
+The generator is quantized with FX graph mode quantization, calibrated on validation
+samples, and saved as TorchScript, which test.py loads with inference_backend = torchscript.
+"""
+
+import logging
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (
+    MinMaxObserver,
+    QConfig,
+    default_per_channel_weight_observer,
+    get_default_qconfig_mapping,
+)
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+import config.config as config
+from GAN_models.wind_field_GAN_3D import create_generator
+from tools.generatorcomparison import compare_generators
+
+
+def quantize_generator(
+    G: nn.Module, calibration_batches: list, backend: str = "fbgemm"
+) -> nn.Module:
+    """
+    Returns an int8 copy of the float generator G, with activation ranges calibrated
+    on calibration_batches, a list of (LR, Z). G must be built with script_RDB_convs=False
+    and dense_block_mode concat so it can be traced.
+    Activations use min/max observers, the default histogram observers need several GB
+    to merge the histograms of the large, differently scaled 3D activations.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_global(
+        QConfig(
+            activation=MinMaxObserver.with_args(reduce_range=backend == "fbgemm"),
+            weight=default_per_channel_weight_observer,
+        )
+    )
+    prepared = prepare_fx(G.eval(), qconfig_mapping, calibration_batches[0])
+    with torch.no_grad():
+        for LR, Z in calibration_batches:
+            prepared(LR, Z)
+    return convert_fx(prepared)
+
+
+def quantize(cfg: config.Config, dataset_validation, dataset_test):
+    """
+    Quantizes the generator at cfg.env.generator_load_path, saves it next to the run's
+    other models and reports latency, size, PSNR and pix error against fp32 on the test set
+    """
+    status_logger = logging.getLogger("status")
+    cfg_q: config.QuantizationConfig = cfg.quantization
+    if cfg.gan_config.conv_mode != "3D":
+        raise NotImplementedError(
+            f"int8 quantization is only implemented for conv_mode 3D, not {cfg.gan_config.conv_mode}"
+        )
+
+    G = create_generator(cfg, script_RDB_convs=False, dense_block_mode="concat")
+    G.load_state_dict(torch.load(cfg.env.generator_load_path, map_location="cpu"))
+    G.eval()
+
+    calibration_batches = []
+    for i in range(min(cfg_q.calibration_samples, len(dataset_validation))):
+        LR, _, Z = dataset_validation[i][:3]
+        calibration_batches.append((LR.unsqueeze(0), Z.unsqueeze(0)))
+    status_logger.info(
+        f"quantization: calibrating on {len(calibration_batches)} validation samples"
+    )
+    G_int8 = quantize_generator(G, calibration_batches, backend=cfg_q.backend)
+    G_int8 = torch.jit.trace(G_int8, calibration_batches[0])
+
+    save_path = os.path.join(cfg.env.this_runs_folder, "G_int8.pt")
+    torch.jit.save(G_int8, save_path)
+    status_logger.info(
+        f"quantization: saved int8 generator to {save_path}, set [ENV] exported_generator_path and [GENERATOR] inference_backend = torchscript to use it"
+    )
+
+    number_of_samples = cfg_q.report_samples
+    if number_of_samples <= 0 or number_of_samples > len(dataset_test):
+        number_of_samples = len(dataset_test)
+    report = compare_generators(
+        {"fp32": G, "int8": G_int8}, dataset_test, number_of_samples
+    )
+    status_logger.info(
+        f"quantization: fp32 vs int8 on {number_of_samples} test samples\n{report}"
+    )
+    print(report)
@@ -0,0 +1,112 @@
+"""
+sampling.py
+Apache License
+
+Implements a loss driven importance sampler for the training dataloader.
+"""
+
+import collections
+import math
+
+import numpy as np
+import torch
+
+
+class ImportanceSampler(torch.utils.data.Sampler):
+    """
+    ImportanceSampler draws batches of samples with probability proportional to a
+    running average of their G training loss, mixed with a uniform floor:
+        p_i = (1 - uniform_mix) * loss_i / sum(loss) + uniform_mix / N
+    If number_of_regions > 1, every sample is split into number_of_regions^2 slice
+    regions which are tracked separately, and the yielded keys are (index, region).
+    Use it as batch_sampler. The dataloader returns batches in the order they are
+    yielded, so pop_batch() returns the keys and per-sample importance weights of the
+    batch that was just received.
+    """
+
+    def __init__(
+        self,
+        number_of_samples: int,
+        batch_size: int,
+        uniform_mix: float = 0.5,
+        loss_ema: float = 0.9,
+        number_of_regions: int = 1,
+    ):
+        if not 0.0 < uniform_mix <= 1.0:
+            raise ValueError("importance sampling uniform_mix must be in (0, 1]")
+        self.number_of_samples = number_of_samples
+        self.batch_size = batch_size
+        self.uniform_mix = uniform_mix
+        self.loss_ema = loss_ema
+        self.number_of_regions = number_of_regions
+        self.number_of_keys = number_of_samples * number_of_regions**2
+
+        self.running_loss = np.zeros(self.number_of_keys)
+        self.seen = np.zeros(self.number_of_keys, dtype=bool)
+        self.pending_batches = collections.deque()
+        self.pending_update = None
+
+    def __len__(self):
+        return math.ceil(self.number_of_samples / self.batch_size)
+
+    def __iter__(self):
+        # batches prefetched by the previous dataloader iterator are never returned
+        self.pending_batches.clear()
+        for _ in range(len(self)):
+            keys, weight = self.sample_batch()
+            self.pending_batches.append((keys, weight))
+            if self.number_of_regions == 1:
+                yield keys.tolist()
+            else:
+                yield [
+                    (
+                        int(key // self.number_of_regions**2),
+                        int(key % self.number_of_regions**2),
+                    )
+                    for key in keys
+                ]
+
+    def probabilities(self) -> np.ndarray:
+        loss = self.running_loss.copy()
+        # unseen keys are treated as the hardest seen so far
+        loss[~self.seen] = loss[self.seen].max() if self.seen.any() else 1.0
+        if loss.sum() <= 0.0:
+            return np.full(self.number_of_keys, 1.0 / self.number_of_keys)
+        return (1.0 - self.uniform_mix) * loss / loss.sum() + (
+            self.uniform_mix / self.number_of_keys
+        )
+
+    def sample_batch(self):
+        p = self.probabilities()
+        keys = np.random.choice(self.number_of_keys, size=self.batch_size, p=p)
+        # the batch mean of the losses weighted by 1 / (N p) keeps the expected gradient unbiased
+        weights = 1.0 / (self.number_of_keys * p[keys])
+        return keys, weights
+
+    def pop_batch(self):
+        return self.pending_batches.popleft()
+
+    def update(self, keys: np.ndarray, losses: torch.Tensor):
+        """
+        Stores the per-sample G losses of the batch with the given keys. The losses are
+        read on the next call, when the step that produced them has finished, to avoid a
+        device sync.
+        """
+        self.flush()
+        self.pending_update = (keys, losses.detach())
+
+    def flush(self):
+        if self.pending_update is None:
+            return
+        keys, losses = self.pending_update
+        self.pending_update = None
+        losses = losses.float().cpu().numpy().reshape(-1)
+        finite = np.isfinite(losses)
+        keys, losses = keys[finite], losses[finite]
+        first_visit = ~self.seen[keys]
+        self.running_loss[keys] = np.where(
+            first_visit,
+            losses,
+            self.loss_ema * self.running_loss[keys] + (1.0 - self.loss_ema) * losses,
+        )
+        self.seen[keys] = True
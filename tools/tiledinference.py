@@ -0,0 +1,206 @@
+"""
+tiledinference.py
+Apache License
+
+Implements tiled inference of Generator_3D over domains of arbitrary horizontal size.
+LR is split into overlapping xy tiles, the tiles are super-resolved in batches and the
+results are blended with linear ramps over the overlaps.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+
+
+def receptive_field_radius(G: nn.Module, scale: int) -> int:
+    """
+    Upper bound of the horizontal receptive field radius of G, in LR pixels.
+    Every conv adds (kernel_size - 1) // 2 pixels at the resolution it runs at.
+    The terrain branch runs in parallel to the LR trunk and upsampler.
+    """
+
+    def radius(module: nn.Module, resolution: float):
+        total = 0.0
+        name = getattr(module, "original_name", type(module).__name__)
+        if isinstance(module, nn.Upsample):
+            scale_factor = module.scale_factor
+            resolution *= (
+                scale_factor[0] if isinstance(scale_factor, tuple) else scale_factor
+            )
+        if name in {"PixelShuffle", "PixelShuffle_xy"}:
+            resolution *= module.upscale_factor
+        if name in {"Horizontal_Conv_3D", "RDB_Horizontal_Conv_3D"}:
+            # the convs of the levels run in parallel
+            return radius(module.convs[0], resolution)
+        weight = dict(module.named_parameters(recurse=False)).get("weight")
+        if weight is not None and weight.dim() >= 4:
+            total += ((weight.shape[2] - 1) // 2) / resolution
+        for child in module.children():
+            child_radius, resolution = radius(child, resolution)
+            total += child_radius
+        return total, resolution
+
+    trunk_radius, _ = radius(G.model, 1.0)
+    terrain_radius, _ = radius(G.terrain_convs, float(scale))
+    hr_radius, _ = radius(G.hr_convs, float(scale))
+    return math.ceil(max(trunk_radius, terrain_radius) + hr_radius)
+
+
+def tile_halo(tile_size: int, halo: int = -1, receptive_field: int = None) -> int:
+    """
+    Halo of tile_size tiles, at most tile_size // 4 so that neighbouring tiles overlap by at
+    most half a tile and the tile step is at least tile_size // 2. A negative halo is sized from
+    the receptive field radius, 2 * receptive_field for exact tiling, capped at tile_size // 4,
+    or tile_size // 4 without receptive_field. Raises ValueError for a larger explicit halo.
+    """
+    max_halo = tile_size // 4
+    if halo < 0:
+        if receptive_field is None:
+            return max_halo
+        return min(2 * receptive_field, max_halo)
+    if halo > max_halo:
+        raise ValueError(
+            f"tile_halo {halo} is larger than tile_size // 4 = {max_halo}, use a tile_size of at least {4 * halo} or a smaller tile_halo"
+        )
+    return halo
+
+
+def halo_covers_receptive_field(halo: int, receptive_field: int) -> bool:
+    """Tiled inference equals whole-domain inference if the receptive field radius is at most halo / 2"""
+    return receptive_field <= halo / 2
+
+
+def tile_starts(size: int, tile_size: int, halo: int) -> list:
+    if size <= tile_size:
+        return [0]
+    step = tile_size - 2 * halo
+    starts = list(range(0, size - tile_size + 1, step))
+    if starts[-1] + tile_size < size:
+        starts.append(size - tile_size)
+    return starts
+
+
+def blending_ramp(
+    start: int, length: int, size: int, halo: int, device: torch.device
+) -> torch.Tensor:
+    """
+    Weights of a tile covering [start, start + length) of a dimension of the given size,
+    for tiles overlapping by 2 * halo pixels. At every edge that is not on the domain
+    boundary, the outer halo / 2 pixels get weight 0 and the next halo pixels a linear
+    ramp, so the weights of two neighbouring tiles cross-fade and sum to 1.
+    """
+    ramp = torch.ones(length, device=device)
+    if halo <= 0:
+        return ramp
+    distance = torch.arange(length, device=device, dtype=torch.float32)
+    edge_ramp = ((distance - halo / 2 + 0.5) / halo).clamp(min=0.0, max=1.0)
+    if start > 0:
+        ramp = torch.minimum(ramp, edge_ramp)
+    if start + length < size:
+        ramp = torch.minimum(ramp, edge_ramp.flip(0))
+    return ramp
+
+
+@torch.no_grad()
+def tiled_forward(
+    G: nn.Module,
+    LR: torch.Tensor,
+    Z: torch.Tensor,
+    scale: int,
+    tile_size: int,
+    halo: int = -1,
+    tiles_per_batch: int = 4,
+    device: torch.device = None,
+    receptive_field: int = None,
+) -> torch.Tensor:
+    """
+    Super-resolves LR (batch, channels, x, y, z) with terrain Z (batch, 1, scale*x, scale*y, z)
+    in tile_size x tile_size LR tiles, overlapping by 2 * tile_halo(tile_size, halo,
+    receptive_field) LR pixels. The result equals whole-domain inference if
+    halo_covers_receptive_field, otherwise it
+    differs near the tile seams, see tiling_error. Only the tiles of one batch are on the
+    device at a time, the result is assembled on the device of LR.
+    """
+    if device is None:
+        device = next(G.parameters()).device
+    halo = tile_halo(tile_size, halo, receptive_field)
+
+    size_x, size_y = LR.shape[2], LR.shape[3]
+    tiles = [
+        (x_start, y_start)
+        for x_start in tile_starts(size_x, tile_size, halo)
+        for y_start in tile_starts(size_y, tile_size, halo)
+    ]
+    tile_x, tile_y = min(tile_size, size_x), min(tile_size, size_y)
+
+    SR, weight_sum = None, torch.zeros(
+        (1, 1, scale * size_x, scale * size_y, 1), device=LR.device
+    )
+    for first in range(0, len(tiles), tiles_per_batch):
+        batch_tiles = tiles[first : first + tiles_per_batch]
+        LR_tiles = torch.cat(
+            [LR[:, :, x : x + tile_x, y : y + tile_y] for x, y in batch_tiles]
+        )
+        Z_tiles = torch.cat(
+            [
+                Z[
+                    :,
+                    :,
+                    scale * x : scale * (x + tile_x),
+                    scale * y : scale * (y + tile_y),
+                ]
+                for x, y in batch_tiles
+            ]
+        )
+        SR_tiles = G(
+            LR_tiles.to(device, non_blocking=True),
+            Z_tiles.to(device, non_blocking=True),
+        ).to(LR.device)
+
+        if SR is None:
+            SR = torch.zeros(
+                (
+                    LR.shape[0],
+                    SR_tiles.shape[1],
+                    *weight_sum.shape[2:4],
+                    SR_tiles.shape[4],
+                ),
+                dtype=SR_tiles.dtype,
+                device=LR.device,
+            )
+        for i, (x, y) in enumerate(batch_tiles):
+            weight = (
+                blending_ramp(
+                    scale * x, scale * tile_x, scale * size_x, scale * halo, LR.device
+                )[:, None]
+                * blending_ramp(
+                    scale * y, scale * tile_y, scale * size_y, scale * halo, LR.device
+                )[None, :]
+            )[None, None, :, :, None]
+            x_slice = slice(scale * x, scale * (x + tile_x))
+            y_slice = slice(scale * y, scale * (y + tile_y))
+            SR_tile = SR_tiles[i * LR.shape[0] : (i + 1) * LR.shape[0]]
+            SR[:, :, x_slice, y_slice] += weight * SR_tile
+            weight_sum[:, :, x_slice, y_slice] += weight
+
+    return SR / weight_sum
+
+
+@torch.no_grad()
+def tiling_error(
+    G: nn.Module,
+    LR: torch.Tensor,
+    Z: torch.Tensor,
+    SR_tiled: torch.Tensor,
+    device: torch.device = None,
+) -> dict:
+    """Difference between tiled and whole-domain inference"""
+    if device is None:
+        device = next(G.parameters()).device
+    SR = G(LR.to(device), Z.to(device)).to(SR_tiled.device)
+    difference = (SR_tiled - SR).abs()
+    return {
+        "max_abs_diff": difference.max().item(),
+        "mean_abs_diff": difference.mean().item(),
+    }
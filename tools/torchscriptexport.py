@@ -0,0 +1,105 @@
+"""
+torchscriptexport.py
+Apache License
+
+Exports Generator_3D as a single frozen TorchScript module, with the weights folded into
+the graph as constants, which test.py loads with inference_backend = torchscript without
+constructing the model in Python.
+"""
+
+import json
+import logging
+import os
+import time
+
+import torch
+
+import config.config as config
+from GAN_models.wind_field_GAN_3D import create_generator
+from tools.tiledinference import receptive_field_radius
+
+# extra file of frozen exports, a json dict with the receptive field radius of the generator
+METADATA_FILE = "generator.json"
+
+
+def torchscript_path(cfg: config.Config) -> str:
+    """generator_load_path with the _frozen.pt suffix, next to the weights and their config"""
+    return os.path.splitext(cfg.env.generator_load_path)[0] + "_frozen.pt"
+
+
+def load_torchscript_generator(path: str, device: torch.device) -> tuple:
+    """
+    Loads a TorchScript generator, and returns it, the device it runs on and its receptive
+    field radius, None if it is not known. Frozen exports are optimized for inference after
+    loading, since the optimized graph can not be saved.
+    """
+    extra_files = {METADATA_FILE: ""}
+    G = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    if not extra_files[METADATA_FILE]:
+        # quantized generators keep their weights packed instead of as parameters,
+        # and only run on the cpu
+        device = device if any(True for _ in G.parameters()) else torch.device("cpu")
+        return G.to(device).eval(), device, None
+
+    metadata = json.loads(extra_files[METADATA_FILE])
+    if device.type != "cpu":
+        # the weights of frozen modules are constants, which .to() does not move
+        G = torch.jit.load(path, map_location=device)
+    return torch.jit.optimize_for_inference(G), device, metadata["receptive_field"]
+
+
+def export_torchscript(
+    cfg: config.Config, dataset_validation, tolerance: float = 1e-4
+) -> str:
+    """
+    Traces the generator at cfg.env.generator_load_path on a validation sample, freezes and
+    saves it, and checks the loaded module against PyTorch on the sample and on a horizontally
+    cropped copy of it, to verify the dynamic x/y sizes. Returns the path of the exported model.
+    """
+    status_logger = logging.getLogger("status")
+    device = cfg.device
+    G = create_generator(
+        cfg,
+        device=device,
+        script_RDB_convs=False,
+        dense_block_mode="concat",
+        checkpoint_RRDBs=0,
+    )
+    G.load_state_dict(torch.load(cfg.env.generator_load_path, map_location="cpu"))
+    G.to(device).eval()
+
+    LR, _, Z = dataset_validation[0][:3]
+    LR, Z = LR.unsqueeze(0).to(device), Z.unsqueeze(0).to(device)
+    path = torchscript_path(cfg)
+    start = time.perf_counter()
+    with torch.no_grad():
+        G_frozen = torch.jit.freeze(torch.jit.trace(G, (LR, Z)))
+    metadata = {"receptive_field": receptive_field_radius(G, cfg.scale)}
+    torch.jit.save(G_frozen, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    status_logger.info(
+        f"torchscript: exported frozen generator to {path} in {time.perf_counter() - start:.1f} s"
+    )
+
+    start = time.perf_counter()
+    G_frozen, _, __ = load_torchscript_generator(path, device)
+    status_logger.info(
+        f"torchscript: loaded and optimized the frozen generator in {(time.perf_counter() - start) * 1000:.0f} ms"
+    )
+
+    cropped_size = max(LR.shape[2] // 2, 1), max(LR.shape[3] // 2, 1)
+    checks = {
+        f"{LR.shape[2]}x{LR.shape[3]}": (LR, Z),
+        f"{cropped_size[0]}x{cropped_size[1]}": (
+            LR[:, :, : cropped_size[0], : cropped_size[1]],
+            Z[:, :, : cropped_size[0] * cfg.scale, : cropped_size[1] * cfg.scale],
+        ),
+    }
+    with torch.no_grad():
+        for size, (LR_check, Z_check) in checks.items():
+            max_diff = (G(LR_check, Z_check) - G_frozen(LR_check, Z_check)).abs().max()
+            message = f"torchscript: max abs diff to pytorch on a {size} LR input: {max_diff.item():.3g}"
+            if max_diff > tolerance:
+                status_logger.warning(f"{message}, above the tolerance {tolerance}")
+            else:
+                status_logger.info(message)
+    return path
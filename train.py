@@ -6,6 +6,7 @@ Apache License
 Implements a GAN training loop
 Use run.py to run.
 """
+import itertools
 import logging
 import os
 import pickle as pkl
@@ -19,6 +20,8 @@ import matplotlib.pyplot as plt
 
 from GAN_models.wind_field_GAN_3D import wind_field_GAN_3D
 import iocomponents.displaybar as displaybar
+from tools.dataloading import CachedValidationSet, PinnedBatchRing
+from tools.sampling import ImportanceSampler
 
 
 def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
@@ -32,15 +35,58 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
     torch.backends.cudnn.benckmark = True
 
     dataloader_train, dataloader_val = None, None
+    sampler = None
+    ring = None
+    curriculum = sorted(cfg_t.slice_size_curriculum)
+    stage = None
+    if cfg.dataset_train and curriculum:
+        validate_curriculum(curriculum, cfg.scale, dataset_train.x.size)
+        # the curriculum crops the training samples, so x and y cover the full
+        # domain and are cut to the HR size in the loss
+        dataset_train.enable_slicing = True
+        x = torch.from_numpy(dataset_train.x).float()
+        y = torch.from_numpy(dataset_train.y).float()
+        stage = curriculum_stage(curriculum, 1)
+        dataset_train.slice_size = stage[0]
+        status_logger.info(f"slice size curriculum: {curriculum}")
+    if cfg.dataset_train and cfg_t.use_importance_sampling:
+        number_of_regions = cfg_t.importance_sampling_regions
+        if number_of_regions > 1 and not dataset_train.enable_slicing:
+            status_logger.warning(
+                "importance sampling regions require enable_slicing - tracking whole samples"
+            )
+            number_of_regions = 1
+        dataset_train.number_of_slice_regions = number_of_regions
+        sampler = ImportanceSampler(
+            len(dataset_train),
+            cfg.dataset_train.batch_size,
+            uniform_mix=cfg_t.importance_sampling_uniform_mix,
+            loss_ema=cfg_t.importance_sampling_loss_ema,
+            number_of_regions=number_of_regions,
+        )
+    if cfg.dataset_train and cfg.dataset_train.pinned_ring_size > 0:
+        if cfg.dataset_train.num_workers > 0:
+            status_logger.warning(
+                "pinned_ring_size is only used without worker processes (num_workers = 0) - using the dataloader's pin_memory"
+            )
+        else:
+            ring = PinnedBatchRing(
+                cfg.dataset_train.batch_size,
+                ring_size=cfg.dataset_train.pinned_ring_size,
+                pin_memory=cfg.device.type == "cuda",
+            )
     if cfg.dataset_train:
-        dataloader_train = torch.utils.data.DataLoader(
+        dataloader_train = create_train_dataloader(
+            cfg,
             dataset_train,
-            batch_size=cfg.dataset_train.batch_size,
-            shuffle=True,
-            num_workers=cfg.dataset_train.num_workers,
-            pin_memory=True,
+            cfg.dataset_train.batch_size if stage is None else stage[1],
+            sampler=sampler,
+            ring=ring,
+        )
+        status_logger.info(
+            "finished creating training dataloader and dataset"
+            + (" with importance sampling" if sampler is not None else "")
         )
-        status_logger.info("finished creating training dataloader and dataset")
     else:
         raise ValueError("can't train without a training dataset - adjust the config")
     if cfg.dataset_val:
@@ -51,6 +97,7 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
             num_workers=cfg.dataset_val.num_workers,
             pin_memory=True,
         )
+        dataloader_val = cache_validation_batches(cfg, dataloader_val, status_logger)
         status_logger.info("finished creating validation dataloader and dataset")
     else:
         status_logger.warning(
@@ -70,8 +117,6 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
 
     start_epoch = 0
     it = 0
-    it_per_epoch = len(dataloader_train)
-    count_train_epochs = 1 + cfg_t.niter // it_per_epoch
     loaded_it = 0
     wind_comp_dict = {0: "u", 1: "v", 2: "w"}
 
@@ -118,21 +163,45 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
         profile_memory=True,
         record_shapes=True,
     ) as profiler:
-        for epoch in range(start_epoch, count_train_epochs):
+        for epoch in itertools.count(start_epoch):
+            if it > cfg_t.niter:
+                break
             status_logger.debug("epoch {epoch}")
 
+            if curriculum and curriculum_stage(curriculum, it + 1) != stage:
+                stage = curriculum_stage(curriculum, it + 1)
+                status_logger.info(
+                    f"it {it}: training on {stage[0]}x{stage[0]} slices with batch size {stage[1]}"
+                )
+                dataset_train.slice_size = stage[0]
+                dataloader_train = create_train_dataloader(
+                    cfg, dataset_train, stage[1], sampler=sampler, ring=ring
+                )
+                bar = displaybar.DisplayBar(
+                    max_value=len(dataloader_train),
+                    start_epoch=epoch,
+                    start_it=it,
+                    niter=cfg_t.niter,
+                )
+
             # dataloader -> (LR, HR, HR_img_name)
 
             for i, (LR, HR, Z) in enumerate(dataloader_train):
                 if it > cfg_t.niter:
                     break
+                if curriculum and curriculum_stage(curriculum, it + 1) != stage:
+                    # start a new epoch with the next stage's dataloader
+                    break
 
                 it += 1
                 bar.update(i, epoch, it)
 
-                LR = LR.to(cfg.device, non_blocking=True)
-                HR = HR.to(cfg.device, non_blocking=True)
-                Z = Z.to(cfg.device, non_blocking=True)
+                if ring is not None:
+                    LR, HR, Z = ring.to_device((LR, HR, Z), cfg.device)
+                else:
+                    LR = LR.to(cfg.device, non_blocking=True)
+                    HR = HR.to(cfg.device, non_blocking=True)
+                    Z = Z.to(cfg.device, non_blocking=True)
 
                 if it == loaded_it + 1:
                     x = x.to(cfg.device, non_blocking=True)
@@ -145,7 +214,23 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
                         cfg_t.d_g_train_period,
                     )
 
-                gan.optimize_parameters(LR, HR, Z, it)
+                if sampler is not None:
+                    sample_keys, loss_weights = sampler.pop_batch()
+                    gan.optimize_parameters(
+                        LR,
+                        HR,
+                        Z,
+                        it,
+                        loss_weight=torch.as_tensor(
+                            loss_weights, dtype=torch.float32, device=cfg.device
+                        ),
+                    )
+                    if gan.is_G_iteration(it):
+                        sampler.update(
+                            sample_keys, gan.get_G_train_loss_per_sample_ref()
+                        )
+                else:
+                    gan.optimize_parameters(LR, HR, Z, it)
 
                 profiler.step()
 
@@ -221,7 +306,7 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
                     with torch.no_grad():
                         SR_i = (
                             dataset_train.UVW_MAX
-                            * gan.G(
+                            * gan.generate(
                                 LR_i,
                                 torch.index_select(Z, 0, batch_quiver, out=None),
                             )
@@ -337,6 +422,78 @@ def train(cfg: config.Config, dataset_train, dataset_validation, x, y):
     return
 
 
+def create_train_dataloader(
+    cfg: config.Config, dataset_train, batch_size: int, sampler=None, ring=None
+):
+    """
+    With a PinnedBatchRing, which is only used without worker processes, the ring
+    replaces the default collate and the dataloader's pin_memory stage
+    """
+    loader_kwargs = dict(
+        num_workers=cfg.dataset_train.num_workers,
+        pin_memory=ring is None,
+    )
+    if ring is not None:
+        ring.batch_size = batch_size
+        loader_kwargs["collate_fn"] = ring.collate
+    if sampler is not None:
+        sampler.batch_size = batch_size
+        return torch.utils.data.DataLoader(
+            dataset_train, batch_sampler=sampler, **loader_kwargs
+        )
+    return torch.utils.data.DataLoader(
+        dataset_train, batch_size=batch_size, shuffle=True, **loader_kwargs
+    )
+
+
+def cache_validation_batches(
+    cfg: config.Config, dataloader_val, status_logger: logging.Logger
+):
+    if not cfg.dataset_val.cache_batches:
+        return dataloader_val
+    if (
+        cfg.dataset_val.data_aug_rot
+        or cfg.dataset_val.data_aug_flip
+        or cfg.gan_config.enable_slicing
+    ):
+        # every validation epoch would reuse one random augmentation or crop per sample
+        status_logger.warning(
+            "validation batches are not cached since data_aug_rot, data_aug_flip or enable_slicing is on"
+        )
+        return dataloader_val
+    dataloader_val = CachedValidationSet(
+        dataloader_val, cfg.device, cfg.dataset_val.cache_memory_budget_MB
+    )
+    status_logger.info(
+        f"cached {len(dataloader_val)} validation batches, {dataloader_val.number_of_device_batches} on {cfg.device}"
+    )
+    return dataloader_val
+
+
+def curriculum_stage(curriculum: list, it: int):
+    """
+    Returns (slice_size, batch_size) of the last curriculum stage
+    [start_iteration, slice_size, batch_size] starting at or before it
+    """
+    stage = curriculum[0]
+    for next_stage in curriculum:
+        if next_stage[0] <= it:
+            stage = next_stage
+    return stage[1], stage[2]
+
+
+def validate_curriculum(curriculum: list, scale: int, domain_size: int):
+    for stage in curriculum:
+        if len(stage) != 3:
+            raise ValueError(
+                f"slice_size_curriculum stages are [start_iteration, slice_size, batch_size], not {stage}"
+            )
+        if stage[1] % scale != 0 or stage[1] > domain_size:
+            raise ValueError(
+                f"curriculum slice size {stage[1]} must be a multiple of the scale {scale} and at most {domain_size}"
+            )
+
+
 def save_validation_images_to_tb(
     title,
     wind_height_index,